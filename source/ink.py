@@ -7,41 +7,158 @@ import time
 import subprocess
 import argparse
 import configparser
-import datetime
+import json
+import re
+import shlex
 import shutil
+import tempfile
+import concurrent.futures
+import threading
 import logging
 import logging.handlers
 from enum import Enum
 
 LOG_RELATIVE_PATH = 'ink/ink.log'
 
+# Directives supported by strftime but not by strptime, and their equivalents
+STRPTIME_EQUIVALENTS = {'F': '%Y-%m-%d', 'T': '%H:%M:%S', 'R': '%H:%M'}
 
-def run_shell_command(command, error_string='Shell command failed.'):
+# Directives giving each unit of time, from the largest unit to the smallest.
+# The day of the year gives both the month and the day.
+DATE_FORMAT_UNITS = ('Yy', 'mbBj', 'dj', 'H', 'M', 'S')
+
+
+def run_shell_command(command, error_string='Shell command failed.', env=None,
+                      logger=None):
     '''
     Run a shell command given as a list of strings corresponding to the
     arguments. If the command fails, raise a RuntimeError with the
-    error string given.
+    error string given. If env is given, it replaces the environment of
+    the command, otherwise the current environment is inherited. If logger
+    is given, the output of the command is captured and logged line by line,
+    stdout as info and stderr as warnings, otherwise it goes to the inherited
+    stdout and stderr.
     '''
-    # Run shell command
-    p = subprocess.Popen(' '.join(command), shell=True)
-    p.communicate()
-
-    # Check return code and raise error if command did not succeed
-    if p.returncode != 0:
-        raise RuntimeError(error_string)
+    # Look up the full path of the program. subprocess only launches it with
+    # posix_spawn instead of fork and exec if the path contains a directory.
+    path = env.get('PATH') if env is not None else None
+    executable = shutil.which(command[0], path=path) or command[0]
+
+    # Run command directly without an intermediate shell, so arguments
+    # containing spaces are passed through unchanged. The commands never
+    # read from stdin. Files opened by Python (/proc/mounts, the log and
+    # history files) are non-inheritable, so they are closed on exec even
+    # with close_fds=False, which keeps posix_spawn usable.
+    output = None if logger is None else subprocess.PIPE
+    try:
+        with subprocess.Popen(command, executable=executable,
+                              stdin=subprocess.DEVNULL, stdout=output,
+                              stderr=output, close_fds=False, env=env,
+                              errors='replace') as process:
+            # Read both outputs as they are written, so the command never
+            # blocks on a full pipe. stderr is read in a separate thread.
+            if logger is not None:
+                stderr_thread = threading.Thread(
+                    target=_log_lines, args=(process.stderr, logger.warning))
+                stderr_thread.start()
+                _log_lines(process.stdout, logger.info)
+                stderr_thread.join()
+    except OSError as e:
+        raise RuntimeError(error_string) from e
+
+    # Raise the error string if the command did not succeed
+    if process.returncode != 0:
+        raise RuntimeError(error_string) from subprocess.CalledProcessError(
+            process.returncode, command)
+
+
+def _log_lines(stream, log):
+    '''
+    Log each line read from the text stream with the logging function log,
+    until the end of the stream.
+    '''
+    for line in stream:
+        log(line.rstrip('\n'))
 
 
 def path_is_parent(parent_path, child_path):
     '''
     Returns True if parent_path is a parent of child_path, False otherwise.
     '''
-    # Smooth out relative path names, note: if you are concerned about symbolic links, you should use os.path.realpath too
-    parent_path = os.path.realpath(parent_path)
-    child_path = os.path.realpath(child_path)
+    # Resolve symbolic links and relative path names, and end both paths with
+    # exactly one slash so that e.g. /a/bc is not taken to be inside /a/b
+    parent_path = os.path.realpath(parent_path).rstrip('/') + '/'
+    child_path = os.path.realpath(child_path).rstrip('/') + '/'
+
+    # The child is inside the parent if its path starts with the parent path
+    return child_path.startswith(parent_path)
+
+
+def get_mount_points():
+    '''
+    Return the set of mount points currently listed in /proc/mounts, as bytes
+    in the escaped form used by that file (see encode_mount_point).
+    '''
+    # Only the second field (the mount point) of each line is needed. The
+    # file is read in binary mode to skip decoding every line.
+    with open('/proc/mounts', 'rb') as mount_file:
+        return {line.split(b' ', 2)[1] for line in mount_file}
+
 
-    # Compare the common path of the parent and child path with the common path of just the parent path.
-    return os.path.commonpath([parent_path]) == os.path.commonpath(
-        [parent_path, child_path])
+def encode_mount_point(mount_point):
+    '''
+    Return the mount point as bytes in the form listed in /proc/mounts. The
+    path is resolved, and spaces, tabs, newlines and backslashes are escaped
+    as octal sequences.
+    '''
+    encoded = os.fsencode(os.path.realpath(mount_point))
+    for char in b'\\ \t\n':
+        encoded = encoded.replace(bytes([char]),
+                                  '\\{:03o}'.format(char).encode())
+    return encoded
+
+
+class CachedTimeFormatter(logging.Formatter):
+    '''
+    A log formatter that formats the timestamp at most once per second and
+    reuses it for every record logged within that second.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Last formatted second as a (seconds, string) tuple, replaced as a
+        # whole so that handlers sharing this formatter never see a mismatch
+        self._cached_time = (None, '')
+
+    def formatTime(self, record, datefmt=None):
+        '''
+        Format the creation time of the record, reusing the cached string if
+        the record was created in the same second as the previous one.
+        '''
+        # Custom date formats are passed through unchanged
+        if datefmt is not None:
+            return super().formatTime(record, datefmt)
+
+        seconds = int(record.created)
+        cached_seconds, time_string = self._cached_time
+        if seconds != cached_seconds:
+            time_string = time.strftime(self.default_time_format,
+                                        self.converter(seconds))
+            self._cached_time = (seconds, time_string)
+
+        return self.default_msec_format % (time_string, record.msecs)
+
+
+class SectionLoggerAdapter(logging.LoggerAdapter):
+    '''
+    A logger adapter that prefixes each message with the name of the section
+    it belongs to, so that interleaved output of sections running at the same
+    time can be told apart.
+    '''
+
+    def process(self, msg, kwargs):
+        return '[{:s}] {:s}'.format(self.extra['section'], msg), kwargs
 
 
 class PartitionManager:
@@ -51,18 +168,29 @@ class PartitionManager:
 
     MountStatus = Enum('MountStatus', 'NEWLY_MOUNTED ALREADY_MOUNTED')
 
-    def __init__(self, mount_point, uuid, label, dev):
+    # Fixed set of attributes, all assigned in __init__
+    __slots__ = ('_mount_point', '_encoded_mount_point', '_uuid', '_label',
+                 '_dev', '_mount_status', 'logger')
+
+    def __init__(self, mount_point, uuid, label, dev, logger=None):
         ''' Initialize with the mount point of the partition and optionally its
-        UUID, label or device identifier.'''
+        UUID, label or device identifier, and the logger to use.'''
         self._mount_point = mount_point
+        # Resolved and escaped once, to be compared with /proc/mounts
+        self._encoded_mount_point = encode_mount_point(mount_point)
         self._uuid = uuid
         self._label = label
         self._dev = dev
 
+        # Partitions are only unmounted if they were mounted by this object
+        self._mount_status = self.MountStatus.ALREADY_MOUNTED
+
         # Logger
-        self.logger = logging.getLogger(__name__)
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
 
-    def mount_partition(self):
+    def mount_partition(self, mount_points=None):
         '''
         Mount the partition to the mount point specified in the
         constructor. The partition to mount is identified as follows:
@@ -71,14 +199,21 @@ class PartitionManager:
             - by device identifier, if given
             - if none of the above are given: by entry in /etc/fstab
             - if no entry in /etc/fstab exists: error
+        If mount_points (a set as returned by get_mount_points) is given, it
+        is used instead of reading /proc/mounts and is updated after the
+        partition is mounted.
         '''
-        # Initialize mount status
-        self._mount_status = self.MountStatus.ALREADY_MOUNTED
+        # Partition was already mounted by this object and has not been
+        # unmounted since, so there is no need to check the mounts again.
+        # Keeping the status also makes sure it is still unmounted later.
+        if self._mount_status == self.MountStatus.NEWLY_MOUNTED:
+            self.logger.info('Partition is already mounted.')
+            return
 
         # Check if a mount point was given
         if len(self._mount_point) == 0:
             self.logger.info('No mount point given. Not mounting a partition.')
-        elif self._is_partition_mounted():
+        elif self._is_partition_mounted(mount_points):
             self.logger.info('Partition is already mounted.')
         else:
             self.logger.info(
@@ -100,17 +235,20 @@ class PartitionManager:
             # Run command
             run_shell_command(shell_command, 'Mounting backup disk failed.')
             self.logger.info('Partition mounted.')
+            if mount_points is not None:
+                mount_points.add(self._encoded_mount_point)
 
             # Set mount status to newly mounted -- means we should unmount it
             # afterwards
             self._mount_status = self.MountStatus.NEWLY_MOUNTED
 
-    def unmount_partition_if_needed(self):
+    def unmount_partition_if_needed(self, mount_points=None):
         '''
         Unmount the partition at the mount point specified in the constructor
         if the partition was not mounted prior to the object being created.
         If the partition was mounted already when the object was created, do
-        nothing.
+        nothing. If mount_points is given, the mount point is removed from it
+        after unmounting.
         '''
         # Only unmount if partition was not previously mounted.
         if self._mount_status == self.MountStatus.NEWLY_MOUNTED:
@@ -120,28 +258,40 @@ class PartitionManager:
             # Unmount device
             run_shell_command(shell_command, 'Unmounting backup disk failed.')
             self.logger.info('Unmounting successful.')
+            self._mount_status = self.MountStatus.ALREADY_MOUNTED
+            if mount_points is not None:
+                mount_points.discard(self._encoded_mount_point)
 
-    def _is_partition_mounted(self):
+    def _is_partition_mounted(self, mount_points=None):
         '''
         Return true if the partition is currently mounted in the file system.
+        If a set of mount points is given, check it instead of reading
+        /proc/mounts.
         '''
-        partition_mounted = False
-        # Check mounts file to see if a partition is mounted at the current
-        # mount point
-        with open('/proc/mounts') as mount_file:
-            for line in mount_file:
-                __, mount_point, __, flags, __, __ = line.split()
-                if mount_point == self._mount_point:
-                    partition_mounted = True
-                    break
+        if mount_points is None:
+            mount_points = get_mount_points()
 
-        return partition_mounted
+        return self._encoded_mount_point in mount_points
 
 
 class BackupInstance:
     ''' A single instance of a backup generator for a specific
     configuration.'''
 
+    # Fixed set of attributes, all assigned in __init__
+    __slots__ = ('name', 'last_backup', 'backup_folder_made', 'logger',
+                 '_partition_manager', '_backup_folder', 'destination',
+                 'to_backup', '_backup_type',
+                 '_exclude_file', '_link_name',
+                 '_symlink_latest_backup_folder', '_symlink_folder',
+                 '_latest_backup_target', '_folder_prefix', '_frequency',
+                 '_rebase_root', '_rsync_log_file', '_force_backup',
+                 '_cross_filesystems', '_date_format', '_rsync_fast_io',
+                 '_parallel_shards', '_bwlimit', '_whole_file',
+                 '_rsync_extra_args', '_ionice_class', '_retain_count',
+                 '_rsync_base', '_rsync_src_arg', '_rsync_extras',
+                 '_rsync_logger', 'backup_prefix', '_strptime_format')
+
     def __init__(self, config, force_backup, last_backup=0):
         ''' Initialize backup instance based on config read from file.'''
         # Check and fix config arguments
@@ -153,63 +303,130 @@ class BackupInstance:
         # Set last backup
         self.last_backup = last_backup
 
+        # Folder holding the backups made by the last successful run, if any
+        self.backup_folder_made = None
+
+        # Logger
+        self.logger = SectionLoggerAdapter(
+            logging.getLogger(__name__), {'section': self.name})
+        self._rsync_logger = SectionLoggerAdapter(
+            logging.getLogger(__name__ + '.rsync'), {'section': self.name})
+
         # Manager for partition where backups should be created
+        mount_point = config.get('mount_point')
         self._partition_manager = PartitionManager(
-            config.get('mount_point'),
+            mount_point,
             config.get('UUID'),
-            config.get('partition_label'), config.get('partition_device'))
+            config.get('partition_label'), config.get('partition_device'),
+            self.logger)
 
         # Backup options
-        self._backup_folder = os.path.join(
-            config.get('mount_point'), config.get('backup_folder'))
+        self._backup_folder = os.path.join(mount_point,
+                                           config.get('backup_folder'))
+
+        # Where the backups are written: the partition if one is mounted, the
+        # backup folder otherwise. Instances with the same or nested
+        # destinations must not run at the same time.
+        self.destination = mount_point if mount_point else self._backup_folder
         self.to_backup = config.get('to_backup')
         self._backup_type = config.get('backup_type')
         self._exclude_file = config.get('exclude_file')
         self._link_name = config.get('link_name')
+        self._symlink_latest_backup_folder = os.path.join(
+            self._backup_folder, self._link_name)
+        self._symlink_folder = os.path.dirname(
+            self._symlink_latest_backup_folder)
+        self._latest_backup_target = None
         self._folder_prefix = config.get('folder_prefix')
-        self._frequency = config.getint('frequency_seconds')
+        self._frequency = self._parse_frequency(config)
         self._rebase_root = config.getboolean('rebase_root')
         self._rsync_log_file = config.get('rsync_log_file')
         self._force_backup = force_backup
         self._cross_filesystems = config.getboolean('cross_filesystems')
         self._date_format = config.get('date_format')
-
-        # Logger
-        self.logger = logging.getLogger(__name__)
-
-    def run(self):
+        self._rsync_fast_io = config.getboolean('rsync_fast_io')
+        self._parallel_shards = self._parse_parallel_shards(config)
+        self._bwlimit = config.get('bwlimit')
+        self._whole_file = config.getboolean('whole_file')
+        self._rsync_extra_args = shlex.split(config.get('rsync_extra_args'))
+        self._ionice_class = config.get('ionice_class')
+        self._retain_count = self._parse_retain_count(config)
+        self._strptime_format = self._get_strptime_format(config)
+
+        # Path of the backup folders up to the date, with the folder holding
+        # them resolved, so that sections sharing it can be found
+        backup_prefix = os.path.join(self._backup_folder, self._folder_prefix)
+        self.backup_prefix = os.path.join(
+            os.path.realpath(os.path.dirname(backup_prefix)),
+            os.path.basename(backup_prefix))
+
+        # Parts of the rsync commands that do not change between runs
+        self._rsync_base = self._get_base_rsync_command()
+        self._rsync_src_arg = self._rsync_src(self.to_backup)
+
+        # Options for the exclude and log files, computed on first use, once
+        # the backup partition is mounted
+        self._rsync_extras = None
+
+    def run(self, mount_points=None, unmount=True):
         '''
         Run backups. Check if current backups are outdated (or if force option
-        was given) and make new backups if necessary.
+        was given) and make new backups if necessary. The optional set of
+        mount points is shared with the partition manager. If unmount is
+        False, a partition mounted for the backups is left mounted and must be
+        unmounted with unmount_partition_if_needed.
         '''
         backups_made = False
+        self.backup_folder_made = None
 
         # Run only if backup is outdate (needs to be run again) or if the force
         # option was given.
         if self._force_backup or self._backup_outdated(self.last_backup):
             self.logger.info('Making new backups.')
             # Mount the drive where the backups should go
-            self._partition_manager.mount_partition()
+            self._partition_manager.mount_partition(mount_points)
             # Make the backups
             try:
                 self._make_backups()
                 backups_made = True
-            except Exception as e:
+            except Exception:
                 self.logger.error('An error occurred making the backups.')
+                # Format the traceback once and log it, which writes it to
+                # both stdout and the log file
                 exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback.print_exception(
-                    exc_type,
-                    exc_value,
-                    exc_traceback,
-                    limit=2,
-                    file=sys.stdout)
-                self.logger.error(str(e))
+                self.logger.error(''.join(
+                    traceback.format_exception(
+                        exc_type, exc_value, exc_traceback,
+                        limit=2)).rstrip())
 
             finally:
-                self._partition_manager.unmount_partition_if_needed()
+                if unmount:
+                    self._partition_manager.unmount_partition_if_needed(
+                        mount_points)
 
         return backups_made
 
+    def backup_due(self):
+        '''
+        Return True if run would make new backups, i.e. if the force option
+        was given or the previous backup is outdated. Nothing is logged.
+        '''
+        return self._force_backup or \
+            self._backup_outdated(self.last_backup, log=False)
+
+    def prunes_backups(self):
+        '''
+        Return True if old backups are removed after making new ones.
+        '''
+        return self._retain_count > 0 and self._backup_type != 'snapshot'
+
+    def unmount_partition_if_needed(self, mount_points=None):
+        '''
+        Unmount the partition holding the backups if it was mounted by this
+        instance.
+        '''
+        self._partition_manager.unmount_partition_if_needed(mount_points)
+
     def _make_backups(self):
         '''
         Run rsync command to make new backups.
@@ -226,84 +443,208 @@ class BackupInstance:
 
     def _get_base_rsync_command(self):
         '''
-        Get the basic rsync command as a list of strings.
+        Get the start of every rsync command of this instance, with the basic
+        and tuning options, as a tuple of strings. If an I/O scheduling class
+        is configured, rsync is run through ionice.
         '''
+        # Run rsync with the given I/O scheduling class, if any
+        if self._ionice_class:
+            shell_command = ['ionice', '-c', self._ionice_class]
+        else:
+            shell_command = []
+
         # Basic command - rsync with archive and update option
-        shell_command = ['rsync', '-au']
+        shell_command.extend(['rsync', '-au'])
 
         # If cross_filesystems disabled, add -x option
         if not self._cross_filesystems:
             shell_command.append('-x')
 
+        # Add tuning options
+        if self._bwlimit:
+            shell_command.append('--bwlimit=' + self._bwlimit)
+        if self._whole_file:
+            shell_command.append('-W')
+        shell_command.extend(self._rsync_extra_args)
+
+        return tuple(shell_command)
+
+    def _get_rsync_command(self, destination, extra_args=(),
+                           log_file_suffix=''):
+        '''
+        Get the full rsync command copying to_backup to destination as a list
+        of strings. The command consists of the base command built in
+        __init__, the extra arguments given, the options for the exclude and
+        log files, and the source and destination. The log_file_suffix is
+        appended to the name of the rsync log file, if there is one.
+        '''
+        shell_command = list(self._rsync_base)
+
+        # Add options specific to the backup type
+        shell_command.extend(extra_args)
+
+        # Add log and exclude files
+        shell_command = self._add_exclude_and_log_files(shell_command,
+                                                        log_file_suffix)
+
+        # Add source and destination
+        shell_command.extend([self._rsync_src_arg, destination])
+
         return shell_command
 
-    def _make_backups_common(self):
+    def _run_rsync_sharded(self, destination, extra_args=()):
         '''
-        Make backups for non-snapshot backup types.
+        Copy to_backup to destination with up to parallel_shards rsync
+        processes running at the same time. A first rsync copies the top level
+        of to_backup without recursing, i.e. the attributes of to_backup
+        itself, its files and its directories as empty directories. The
+        top-level directories are then split evenly into shards, and each
+        shard is copied by its own rsync reading the list of directories with
+        --files-from and writing its own log file.
         '''
-        # Get basename of backup folder
-        new_backup_folder_base = self._get_backup_folder_basename()
+        # Copy the top level first, so that the attributes of the root and
+        # the directories skipped below are copied exactly once
+        self.logger.info('Copying the top level of the backup.')
+        shell_command = self._get_rsync_command(
+            destination, ['--no-r', '-d', *extra_args])
+        run_shell_command(shell_command, logger=self._rsync_logger)
+
+        # Collect top-level directories. Without cross_filesystems,
+        # directories on a different filesystem are skipped, since rsync
+        # would otherwise descend into each listed directory regardless of
+        # -x. They were already copied as empty directories above, as a
+        # single rsync would. The backup folder is skipped as well.
+        source_dev = os.stat(self.to_backup).st_dev
+        backup_folder = os.path.realpath(self._backup_folder)
+        names = []
+        with os.scandir(self.to_backup) as it:
+            for entry in it:
+                if not entry.is_dir(follow_symlinks=False) or \
+                        os.path.realpath(entry.path) == backup_folder:
+                    continue
+                if not self._cross_filesystems and \
+                        entry.stat(follow_symlinks=False).st_dev != source_dev:
+                    continue
+                names.append(entry.name)
+
+        # Distribute the directories over the shards in turn. The size of a
+        # directory tree is not known without walking it, so the shards are
+        # not weighted.
+        names.sort()
+        shards = [names[i::self._parallel_shards]
+                  for i in range(self._parallel_shards)]
+
+        # Write one NUL-separated file list per shard and run the rsync
+        # processes in parallel. -r is given explicitly, since --files-from
+        # turns off the recursion implied by -a.
+        with tempfile.TemporaryDirectory(prefix='ink-') as tmp_dir:
+            shell_commands = []
+            for i, shard in enumerate(shards):
+                if not shard:
+                    continue
+                files_from = os.path.join(tmp_dir, 'shard{:d}'.format(i))
+                with open(files_from, 'wb') as f:
+                    f.write(b'\0'.join(os.fsencode(name) for name in shard))
+                shell_commands.append(
+                    self._get_rsync_command(destination, [
+                        '-r', '--from0', '--files-from=' + files_from,
+                        *extra_args
+                    ], '.shard{:d}'.format(i)))
 
-        # Get name of actual backup folder
-        new_backup_folder = self._get_backup_folder_name(new_backup_folder_base)
-        self.logger.info('New backup folder: ' + new_backup_folder)
+            self.logger.info(
+                'Running {:d} rsync processes in parallel.'.format(
+                    len(shell_commands)))
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max(len(shell_commands), 1)) as executor:
+                futures = [
+                    executor.submit(run_shell_command,
+                                    shell_command,
+                                    logger=self._rsync_logger)
+                    for shell_command in shell_commands
+                ]
+                # Wait for all processes and raise the first error
+                for future in futures:
+                    future.result()
 
+    def _make_backups_common(self):
+        '''
+        Make backups for non-snapshot backup types.
+        '''
         # Get name of previous (symlinked) backup folder
-        symlink_latest_backup_folder = os.path.join(self._backup_folder,
-                                                    self._link_name)
+        symlink_latest_backup_folder = self._symlink_latest_backup_folder
 
-        # Set up rsync command
-        shell_command = self._get_base_rsync_command()
+        # Collect rsync options specific to the backup type
+        extra_args = []
 
-        # Add log and exclude files
-        shell_command = self._add_exclude_and_log_files(shell_command)
+        # Previous backup folder to be moved to the new backup folder
+        previous_backup_folder_base = None
 
-        # Check if symlink to previous backup exists
-        if os.path.isdir(symlink_latest_backup_folder):
+        # Check if symlink to previous backup exists. Only the link itself is
+        # checked here (a single lstat); rsync ignores a --link-dest that does
+        # not exist, but nolinks backups need the previous folder to exist.
+        if os.path.lexists(symlink_latest_backup_folder):
             if self._backup_type == 'incremental':
                 # If incremental -- use hardlinks
-                shell_command.append('--link-dest=' +
-                                     symlink_latest_backup_folder)
-            elif self._backup_type == 'nolinks':
+                extra_args.append('--link-dest=' +
+                                  symlink_latest_backup_folder)
+
+                # Optionally write changed files with fewer, larger writes.
+                # The new backup folder starts out empty, so writing in place
+                # never modifies a file hardlinked to a previous backup.
+                if self._rsync_fast_io:
+                    extra_args.extend(
+                        ['--inplace', '--preallocate', '--block-size=131072'])
+            elif self._backup_type == 'nolinks' and \
+                    os.path.isdir(symlink_latest_backup_folder):
                 # If nolinks -- make backups of changed files
                 # Add option to make backups of changed files
-                shell_command.append('-b')
+                extra_args.append('-b')
 
                 # Get name of last backup folder
-                previous_backup_folder_base = \
-                    os.path.realpath(symlink_latest_backup_folder)
-
-                # Remove the new backup folder
-                shutil.rmtree(new_backup_folder_base)
-
-                # Move the previous backup folder to the new backup folder
-                os.rename(previous_backup_folder_base, new_backup_folder_base)
+                previous_backup_folder_base = self._get_latest_backup_target()
 
-                # Make a new empty directory matching the previous backup
-                # folder base
-                previous_backup_folder_base += '_bak'
-                os.mkdir(previous_backup_folder_base)
+        # Get basename of backup folder. For nolinks backups, the previous
+        # backup folder is moved there instead of creating a new folder.
+        new_backup_folder_base = self._get_backup_folder_basename(
+            previous_backup_folder_base)
 
-                # Get the actual previous backup folder
-                previous_backup_folder = self._get_backup_folder_name(
-                    previous_backup_folder_base)
-
-                # Add previous backup folder as the backup dir for any deleted
-                # files
-                shell_command.extend(['--backup-dir', previous_backup_folder])
+        # Get name of actual backup folder
+        new_backup_folder = self._get_backup_folder_name(new_backup_folder_base)
+        self.logger.info('New backup folder: ' + new_backup_folder)
 
-        # Add source and destination
-        if self.to_backup == '/':
-            shell_command.extend([self.to_backup, new_backup_folder])
+        if previous_backup_folder_base is not None:
+            # Make a new empty directory matching the previous backup folder
+            # base. If that fails, move the previous backup folder back.
+            try:
+                os.mkdir(previous_backup_folder_base + '_bak')
+            except OSError:
+                os.rename(new_backup_folder_base, previous_backup_folder_base)
+                raise
+            previous_backup_folder_base += '_bak'
+
+            # Get the actual previous backup folder
+            previous_backup_folder = self._get_backup_folder_name(
+                previous_backup_folder_base)
+
+            # Add previous backup folder as the backup dir for any deleted
+            # files
+            extra_args.extend(['--backup-dir', previous_backup_folder])
+
+        # Run rsync, split into several processes if configured
+        if self._parallel_shards > 1 and os.path.isdir(self.to_backup):
+            self._run_rsync_sharded(new_backup_folder, extra_args)
         else:
-            shell_command.extend([self.to_backup + '/', new_backup_folder])
-
-        # Run rsync command
-        run_shell_command(shell_command)
+            shell_command = self._get_rsync_command(new_backup_folder,
+                                                    extra_args)
+            run_shell_command(shell_command, logger=self._rsync_logger)
 
         # Replace symlink
-        self._replace_symlink(symlink_latest_backup_folder,
-                              new_backup_folder_base)
+        self._replace_symlink(new_backup_folder_base)
+        self.backup_folder_made = new_backup_folder_base
+
+        # Remove backups beyond the number to keep
+        if self._retain_count > 0:
+            self._prune_old_backups(new_backup_folder_base)
 
         self.logger.info('Backups succeeded.')
 
@@ -317,52 +658,82 @@ class BackupInstance:
         new_backup_folder = self._backup_folder
         self.logger.info('New backup folder: ' + new_backup_folder)
 
-        # Make sure new backup folder has trailing slash
-        if new_backup_folder[-1] != '/':
-            new_backup_folder += '/'
+        # Make sure new backup folder has exactly one trailing slash
+        new_backup_folder = new_backup_folder.rstrip('/') + '/'
 
         # Set up rsync command
-        shell_command = self._get_base_rsync_command()
-        shell_command.append('--delete')
-
-        # Add exclude and log files
-        shell_command = self._add_exclude_and_log_files(shell_command)
-
-        # Add source and destination
-        if self.to_backup == '/':
-            shell_command.extend([self.to_backup, new_backup_folder])
-        else:
-            shell_command.extend([self.to_backup + '/', new_backup_folder])
+        shell_command = self._get_rsync_command(new_backup_folder,
+                                                ['--delete'])
 
         # Run rsync command
-        run_shell_command(shell_command)
+        run_shell_command(shell_command, logger=self._rsync_logger)
+        self.backup_folder_made = self._backup_folder
 
         self.logger.info('Backups succeeded.')
 
-    def _get_backup_folder_basename(self):
+    def _get_backup_folder_basename(self, previous_folder=None):
         '''
         Get base name of folder to hold new backups and create the folder in
         the file system. This folder will be in the 'backup_folder' directory
         and will have a name based on the current date/time in the system time
         zone using the ISO 8601 format. Name clashes are resolved by appending
-        an integer to the end of the folder name.
+        an integer to the end of the folder name, higher than any used
+        before for the same name. If previous_folder is given,
+        it is renamed to the new folder instead of creating an empty one.
         '''
         # Get name of new backup folder
         new_backup_folder_base = os.path.join(
             self._backup_folder,
             self._folder_prefix + \
-            datetime.datetime.now().strftime(self._date_format))
-
-        # Make directory to hold new backup
+            time.strftime(self._date_format, time.localtime(time.time())))
+
+        # Make sure the parent directory exists once, so that each attempt
+        # below is a single atomic mkdir
+        parent_folder, folder_name = os.path.split(new_backup_folder_base)
+        os.makedirs(parent_folder, exist_ok=True)
+
+        # List the names already taken with a single directory scan, so that
+        # clashing names are skipped without a failed mkdir each
+        with os.scandir(parent_folder) as entries:
+            existing_names = {
+                entry.name
+                for entry in entries if entry.name.startswith(folder_name)
+            }
+
+        # Start above the highest number already used for this name, also by
+        # a folder of changed files (ending in _bak), so that the numbers keep
+        # the order in which the folders were made even if lower numbers were
+        # freed by removing old backups
         n = 0
+        for existing_name in existing_names:
+            suffix = existing_name[len(folder_name):]
+            if suffix.endswith('_bak'):
+                suffix = suffix[:-len('_bak')]
+            if not suffix:
+                n = max(n, 1)
+            elif suffix[0] == '_' and suffix[1:].isdigit():
+                n = max(n, int(suffix[1:]) + 1)
+
+        # Make directory to hold new backup. A folder created since the scan
+        # above is still caught by mkdir failing. When renaming, the name is
+        # checked again right before the rename instead.
         while (1):
             if n > 0:
-                tmp_folder_name = new_backup_folder_base + '_' + str(n)
+                tmp_folder_name = folder_name + '_' + str(n)
             else:
-                tmp_folder_name = new_backup_folder_base
+                tmp_folder_name = folder_name
+            if tmp_folder_name in existing_names:
+                n = n + 1
+                continue
+            tmp_folder = os.path.join(parent_folder, tmp_folder_name)
             try:
-                os.makedirs(tmp_folder_name)
-                new_backup_folder_base = tmp_folder_name
+                if previous_folder is None:
+                    os.mkdir(tmp_folder)
+                elif os.path.lexists(tmp_folder):
+                    raise FileExistsError(tmp_folder)
+                else:
+                    os.rename(previous_folder, tmp_folder)
+                new_backup_folder_base = tmp_folder
                 break
             except FileExistsError:
                 n = n + 1
@@ -388,125 +759,344 @@ class BackupInstance:
             new_backup_folder = backup_folder_basename
 
         # Make new backup folder
-        try:
-            os.makedirs(new_backup_folder)
-        except FileExistsError:
-            pass
+        os.makedirs(new_backup_folder, exist_ok=True)
 
-        # Make sure new backup folder has a trailing slash
-        if new_backup_folder[-1] != '/':
-            new_backup_folder = new_backup_folder + '/'
+        # Make sure new backup folder has exactly one trailing slash
+        new_backup_folder = new_backup_folder.rstrip('/') + '/'
 
         return new_backup_folder
 
     @staticmethod
-    def _replace_symlink(symlink_latest_backup_folder, new_backup_folder_base):
+    def _rsync_src(to_backup):
+        '''
+        Return the rsync source argument for to_backup, with a trailing slash
+        so that the contents of the directory are copied rather than the
+        directory itself.
         '''
-        Replace symlink given by symlink_latest_backup_folder with a relative
-        link of the same name pointing to new_backup_folder_base.
+        return to_backup if to_backup == '/' else to_backup + '/'
+
+    def _replace_symlink(self, new_backup_folder_base):
+        '''
+        Replace the symlink pointing to the latest backup with a relative link
+        of the same name pointing to new_backup_folder_base.
         '''
         # Replace previous symlink
         try:
-            os.unlink(symlink_latest_backup_folder)
+            os.unlink(self._symlink_latest_backup_folder)
         except FileNotFoundError:
             pass
 
-        os.symlink(
-            os.path.relpath(
-                os.path.join(new_backup_folder_base),
-                os.path.dirname(symlink_latest_backup_folder)),
-            symlink_latest_backup_folder)
+        # The link and the backup folder usually share a parent directory,
+        # in which case the relative target is just the folder name
+        backup_parent, backup_name = os.path.split(new_backup_folder_base)
+        if backup_parent == self._symlink_folder:
+            link_target = backup_name
+        else:
+            link_target = os.path.relpath(new_backup_folder_base,
+                                          self._symlink_folder)
+
+        os.symlink(link_target, self._symlink_latest_backup_folder)
 
-    def _add_exclude_and_log_files(self, shell_command):
+        # Remember the target so that it does not have to be resolved again
+        self._latest_backup_target = new_backup_folder_base
+
+    def _prune_old_backups(self, new_backup_folder_base):
+        '''
+        Remove the oldest backup folders next to new_backup_folder_base, so
+        that at most retain_count of them remain. Only folders named like the
+        ones made by this instance are counted, i.e. the folder prefix
+        followed by a date in date_format, and ordered by that date. Folders
+        of nolinks backups holding changed files (ending in _bak) are pruned
+        separately, also keeping retain_count of them. The new backup folder
+        is never removed.
+        '''
+        # Backups in nested folders (a date format containing '/') are not
+        # pruned
+        if '/' in self._date_format:
+            self.logger.warning('Backups in nested folders are not pruned.')
+            return
+
+        parent_folder, new_folder_name = os.path.split(new_backup_folder_base)
+        prefix = os.path.basename(self._folder_prefix)
+
+        # Without a prefix, any folder whose name parses as a date would be
+        # taken for a backup
+        if not prefix:
+            self.logger.warning('Backups without a folder prefix are not '
+                                'pruned.')
+            return
+
+        # Collect backup folders with a single directory scan, keyed by the
+        # date in their name. The times of the folders themselves change when
+        # a backup set is copied or its permissions are changed.
+        backups = ([], [])
+        with os.scandir(parent_folder) as entries:
+            for entry in entries:
+                if not entry.name.startswith(prefix) or \
+                        entry.name == new_folder_name or \
+                        not entry.is_dir(follow_symlinks=False):
+                    continue
+                parsed = self._parse_backup_folder_name(
+                    entry.name[len(prefix):])
+                if parsed is not None:
+                    key, is_bak = parsed
+                    backups[is_bak].append((key, entry.path))
+
+        # Remove the oldest folders, keeping room for the new one
+        folders, bak_folders = backups
+        folders.sort()
+        bak_folders.sort()
+        to_remove = folders[:max(len(folders) - self._retain_count + 1, 0)] + \
+            bak_folders[:max(len(bak_folders) - self._retain_count, 0)]
+        for _, path in to_remove:
+            self.logger.info('Removing old backup folder ' + path)
+            shutil.rmtree(path)
+
+    def _parse_backup_folder_name(self, name):
+        '''
+        Parse the name of a backup folder with the folder prefix removed.
+        Return a tuple of a sort key ordering the folders by date and a flag
+        that is True for nolinks folders holding changed files, or None if
+        the name was not made by _get_backup_folder_basename.
+        '''
+        # Folders holding changed files of nolinks backups end in _bak
+        is_bak = name.endswith('_bak')
+        if is_bak:
+            name = name[:-len('_bak')]
+
+        # Name clashes are resolved by appending _N, but the date itself may
+        # end in an underscore and digits too, so both are tried
+        candidates = [(name, 0)]
+        date, separator, number = name.rpartition('_')
+        if separator and number.isdigit():
+            candidates.append((date, int(number)))
+
+        for date, n in candidates:
+            try:
+                parsed_date = time.strptime(date, self._strptime_format)
+            except ValueError:
+                continue
+            return (tuple(parsed_date)[:6], n), is_bak
+
+        return None
+
+    def _get_latest_backup_target(self):
+        '''
+        Return the backup folder the latest-backup symlink points to. The
+        target written by _replace_symlink is reused if there is one;
+        otherwise the link is read with a single readlink rather than
+        resolving every path component.
+        '''
+        if self._latest_backup_target is not None:
+            return self._latest_backup_target
+
+        return os.path.normpath(
+            os.path.join(self._symlink_folder,
+                         os.readlink(self._symlink_latest_backup_folder)))
+
+    def _add_exclude_and_log_files(self, shell_command, log_file_suffix=''):
         '''
         Add arguments for the exclude and logfiles to the rsync command given
-        in shell_command.
+        in shell_command, with log_file_suffix appended to the name of the log
+        file. The arguments are computed once per instance.
         '''
-        # Check if log file given
-        if len(self._rsync_log_file) > 0 and \
-                os.path.exists(os.path.dirname(self._rsync_log_file)):
-            shell_command.extend(['--log-file', self._rsync_log_file])
+        if self._rsync_extras is None:
+            self._rsync_extras = self._get_exclude_and_log_file_args()
+        log_file, exclude_args = self._rsync_extras
+        if log_file:
+            shell_command.extend(['--log-file', log_file + log_file_suffix])
+        shell_command.extend(exclude_args)
+        return shell_command
 
-        # Check if exclude file given
-        if len(self._exclude_file) > 0 and \
-                os.path.exists(self._exclude_file):
-            shell_command.append('--exclude-from=' + self._exclude_file)
+    def _get_exclude_and_log_file_args(self):
+        '''
+        Get the rsync log file, or an empty string if there is none, and the
+        rsync arguments for the exclude files as a tuple of strings.
+        '''
+        exclude_args = []
+        log_file = ''
+        rsync_log_file = self._rsync_log_file
+        exclude_file = self._exclude_file
+        backup_folder = self._backup_folder
+
+        # Check if log file given; the stat is skipped if it is not
+        if rsync_log_file and \
+                os.path.exists(os.path.dirname(rsync_log_file)):
+            log_file = rsync_log_file
+
+        # Check if exclude file given; it may be on the backup partition, so
+        # this is only checked once the partition is mounted
+        if exclude_file and os.path.exists(exclude_file):
+            exclude_args.append('--exclude-from=' + exclude_file)
 
         # Exclude the backup directory if it is a subdirectory of to_backup
-        if len(self._backup_folder) > 0 and path_is_parent(
-                self.to_backup, self._backup_folder):
-            shell_command.extend([
+        if backup_folder and path_is_parent(self.to_backup, backup_folder):
+            exclude_args.extend([
                 '--exclude', os.path.sep + os.path.relpath(
-                    self._backup_folder, self.to_backup)
+                    backup_folder, self.to_backup)
             ])
 
-        return shell_command
+        return log_file, tuple(exclude_args)
 
     @staticmethod
     def _check_config(config):
         '''
         Check the syntax of the config arguments.
         '''
+        # Read each option once
+        to_backup = config.get('to_backup')
+        backup_folder = config.get('backup_folder')
+        mount_point = config.get('mount_point')
+
         # Option 'to_backup' must be given and be an absolute path
-        if len(config.get('to_backup')) == 0:
+        if len(to_backup) == 0:
             raise ValueError("The directory to backup (option 'to_backup') "
                              "must be given.")
-        elif config.get('to_backup')[0] != '/':
+        elif to_backup[0] != '/':
             raise ValueError("The directory to backup (option 'to_backup') "
                              "must be an absolute path.")
 
         # Option 'backup_folder' must be given if no mount point is given
-        if len(config.get('backup_folder')) == 0 and \
-                len(config.get('mount_point')) == 0:
+        if len(backup_folder) == 0 and len(mount_point) == 0:
             raise ValueError("The directory where the backups are stored "
                              "(option 'backup_folder') must be given.")
 
         # Option 'mount_point' should be an absolute path
-        if len(config.get('mount_point')) > 0:
-            if config.get('mount_point')[0] != '/':
+        if len(mount_point) > 0:
+            if mount_point[0] != '/':
                 raise ValueError(
                     "The mount point of the backup partition should "
                     "be an absolute path.")
         else:
             # If mount point is not given, 'backup_folder' should be an
             # absolute path
-            if config.get('backup_folder')[0] != '/':
+            if backup_folder[0] != '/':
                 raise ValueError("No mount point is given, so the backup "
                                  "folder should be an absolute path.")
 
-        # Check that frequency is an int
-        try:
-            config.getint('frequency_seconds')
-        except ValueError:
-            raise ValueError("The frequency of the backups for '{:s}' (option "
-                             "'frequency_seconds') was given as '{:s}', "
-                             "which is not an int!".format(
-                                 config.name, config.get('frequency_seconds')))
-
         # Set all directory arguments to have no trailing slash
         directory_args = [
             'mount_point', 'backup_folder', 'to_backup', 'link_name'
         ]
         for arg in directory_args:
-            if len(config[arg]) > 1 and config[arg][-1] == '/':
-                config[arg] = config[arg][:-1]
+            value = config[arg]
+            # Keep a lone '/' (the root directory) and empty values as-is
+            stripped = value.rstrip('/') or value[:1]
+            if stripped != value:
+                config[arg] = stripped
 
         return config
 
-    def _backup_outdated(self, last_backup):
+    @staticmethod
+    def _parse_frequency(config):
         '''
-        Returns true if the last backup made is outdated.
+        Parse the backup frequency in seconds from the config, raising a
+        ValueError if it is not an int.
         '''
-        self.logger.info('Checking if backup is outdated...')
+        try:
+            return config.getint('frequency_seconds')
+        except ValueError:
+            raise ValueError("The frequency of the backups for '{:s}' (option "
+                             "'frequency_seconds') was given as '{:s}', "
+                             "which is not an int!".format(
+                                 config.name, config.get('frequency_seconds')))
 
-        # Check if the last backup is too old
-        backup_outdated = (time.time() - last_backup) > \
-            self._frequency
+    @staticmethod
+    def _parse_parallel_shards(config):
+        '''
+        Parse the number of parallel rsync processes from the config, raising
+        a ValueError if it is not a positive int.
+        '''
+        try:
+            parallel_shards = config.getint('parallel_shards')
+        except ValueError:
+            parallel_shards = 0
+        if parallel_shards < 1:
+            raise ValueError("The number of parallel rsync processes for "
+                             "'{:s}' (option 'parallel_shards') was given as "
+                             "'{:s}', which is not a positive int!".format(
+                                 config.name, config.get('parallel_shards')))
+        return parallel_shards
 
-        if backup_outdated:
+    @staticmethod
+    def _parse_retain_count(config):
+        '''
+        Parse the number of backups to keep from the config, raising a
+        ValueError if it is not a non-negative int.
+        '''
+        try:
+            retain_count = config.getint('retain_count')
+        except ValueError:
+            retain_count = -1
+        if retain_count < 0:
+            raise ValueError("The number of backups to keep for '{:s}' "
+                             "(option 'retain_count') was given as '{:s}', "
+                             "which is not a non-negative int!".format(
+                                 config.name, config.get('retain_count')))
+        return retain_count
+
+    def _get_strptime_format(self, config):
+        '''
+        Return the date format with the directives not supported by strptime
+        replaced, raising a ValueError if old backups are removed and the
+        dates in the names of the backup folders cannot be parsed or do not
+        sort in the order the backups were made. This is the case unless the
+        date starts with the year and includes no unit of time without the
+        larger ones.
+        '''
+        strptime_format = re.sub(
+            '%(.)',
+            lambda match: STRPTIME_EQUIVALENTS.get(match.group(1),
+                                                   match.group(0)),
+            self._date_format)
+
+        # Backups in nested folders are not pruned, so the format is only
+        # checked for flat folders
+        if self.prunes_backups() and '/' not in self._date_format:
+            try:
+                time.strptime(time.strftime(self._date_format),
+                              strptime_format)
+            except ValueError:
+                raise ValueError("The date format for '{:s}' (option "
+                                 "'date_format') was given as '{:s}', which "
+                                 "cannot be parsed to remove old backups "
+                                 "(option 'retain_count')!".format(
+                                     config.name, self._date_format))
+
+            # A date without the year (or e.g. a time without the day) does
+            # not tell which backup is older across its boundary
+            directives = set(re.findall('%(.)', strptime_format))
+            units = [bool(directives.intersection(unit))
+                     for unit in DATE_FORMAT_UNITS]
+            if not units[0] or units != sorted(units, reverse=True):
+                raise ValueError("The date format for '{:s}' (option "
+                                 "'date_format') was given as '{:s}', which "
+                                 "does not order the backups by date to "
+                                 "remove old ones (option 'retain_count'). "
+                                 "It must include the year and all units of "
+                                 "time larger than the ones it includes, "
+                                 "e.g. '%Y-%m-%dT%H:%M'!".format(
+                                     config.name, self._date_format))
+
+        return strptime_format
+
+    def _backup_outdated(self, last_backup, log=True):
+        '''
+        Returns true if the last backup made is outdated. If log is False,
+        nothing is logged.
+        '''
+        if log:
+            self.logger.info('Checking if backup is outdated...')
+
+        # Check if the last backup is too old. Sections never backed up before
+        # are always outdated.
+        backup_outdated = last_backup == 0 or \
+            (time.time() - last_backup) > self._frequency
+
+        if log and backup_outdated:
             self.logger.info(
                 'Previous backup is outdated. Running new backups.')
-        else:
+        elif log:
             self.logger.info(
                 'Previous backup not outdated. Not running new backups.')
 
@@ -517,13 +1107,45 @@ class BackupManager:
     '''
     Class to manage multiple sets of backups based on configuration files.
     '''
-    HISTORY_RELATIVE_PATH = 'ink/history'
+    HISTORY_RELATIVE_PATH = 'ink/history.json'
+    LEGACY_HISTORY_RELATIVE_PATH = 'ink/history'
     SYSTEM_CONFIG_FILENAME = '/etc/ink/inkrc'
 
+    # Default configuration, built once at class creation
+    _DEFAULT_CONFIG = {
+        'DEFAULT': {
+            'mount_point': '',
+            'backup_folder': '%(mount_point)s',
+            'to_backup': '',
+            'backup_type': 'incremental',
+            'exclude_file': '',
+            'rsync_log_file': '',
+            'UUID': '',
+            'partition_label': '',
+            'partition_device': '',
+            'link_name': 'current',
+            'folder_prefix': 'backup-',
+            'frequency_seconds': '{:d}'.format(60 * 60 * 24),
+            'rebase_root': 'true',
+            'cross_filesystems': 'false',
+            'date_format': '%%Y-%%m-%%dT%%H:%%M',
+            'rsync_fast_io': 'false',
+            'parallel_shards': '1',
+            'bwlimit': '',
+            'whole_file': 'false',
+            'rsync_extra_args': '',
+            'ionice_class': '',
+            'retain_count': '0',
+        }
+    }
+
     def __init__(self, args):
         '''
         Initialize using command line arguments in an object.
         '''
+        # Initialize logger
+        self.logger = logging.getLogger(__name__)
+
         # Set command line arguments
         self.args = args
 
@@ -541,47 +1163,227 @@ class BackupManager:
 
         config = self.parse_config(files_to_parse)
 
-        # Read initial history
-        self.history_reader = configparser.ConfigParser()
-        self.history_reader.read_dict({'DEFAULT': {'last_backup': 0}})
-        self.history_reader.read(self.history_filename)
+        # Read initial history. It is updated from several threads in run.
+        self.history = self._read_history()
+        self._history_lock = threading.Lock()
 
         # Initialize backup instances
         self.backup_instances = []
         for section in config.sections():
-            try:
-                last_backup = self.history_reader.getint(section, 'last_backup')
-            except configparser.NoSectionError:
-                last_backup = 0
+            # Look up the last backup in the already-parsed history; sections
+            # that have never been backed up have no entry
+            last_backup = self.history.get(section, {}).get('last_backup', 0)
 
             self.backup_instances.append(
                 BackupInstance(config[section], self.args.force_backup,
                                last_backup))
 
+        # Backups of sections sharing their folder and prefix cannot be told
+        # apart, so pruning them would remove the backups of other sections
+        self._check_pruned_backups()
+
         # Make history dir
         self._make_system_directory_if_not_exists(self.history_filename)
 
-        # Initialize logger
-        self.logger = logging.getLogger(__name__)
-
     def run(self):
-        # Loop through sections and run backups for each one
+        '''
+        Run the backups of all sections. Up to args.jobs sections with
+        separate destinations run concurrently, while sections whose
+        destinations are the same or nested (and therefore possibly on the
+        same partition) run one after the other. If no section is due,
+        nothing is done. Return a dict mapping the name of each section
+        backed up to the folder holding its new backups.
+        '''
+        # Only run sections that are due. If there are none, the mounted
+        # partitions are not read and the history is not rewritten.
+        due_instances = [
+            backup_instance for backup_instance in self.backup_instances
+            if backup_instance.backup_due()
+        ]
+        if not due_instances:
+            self.logger.info('No backups are due. Nothing to do.')
+            return dict()
+
+        # Read the mounted partitions once for all sections
+        mount_points = get_mount_points()
+
+        # Group sections whose destinations overlap
+        groups = self._group_by_destination(due_instances)
+
+        # Run the groups in a pool of at most args.jobs threads. The threads
+        # spend their time waiting on rsync, so they do not contend for the
+        # GIL.
+        max_workers = max(min(self.args.jobs, len(groups)), 1)
+        first_error = None
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(self._run_group, group, mount_points)
+                for group in groups
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    # Keep going so that the history of the other groups is
+                    # still written, then re-raise below
+                    if first_error is None:
+                        first_error = e
+
+        # Write updated history to a temporary file and move it into place,
+        # so that the history file is never left partially written. The data
+        # is synced before the rename so that a crash cannot leave an empty
+        # file behind either.
+        tmp_history_filename = self.history_filename + '.tmp'
+        with open(tmp_history_filename, 'w') as history_file:
+            json.dump(self.history, history_file)
+            history_file.flush()
+            os.fsync(history_file.fileno())
+        os.replace(tmp_history_filename, self.history_filename)
+
+        if first_error is not None:
+            raise first_error
+
+        return self.get_backup_folders()
+
+    def get_backup_folders(self):
+        '''
+        Return a dict mapping the name of each section backed up by the last
+        run to the folder holding its new backups. If the run failed, only
+        the sections backed up before the failure are included.
+        '''
+        return {
+            backup_instance.name: backup_instance.backup_folder_made
+            for backup_instance in self.backup_instances
+            if backup_instance.backup_folder_made is not None
+        }
+
+    @staticmethod
+    def _group_by_destination(backup_instances):
+        '''
+        Split the backup instances into a list of groups that must run one
+        after the other, because their destinations are the same or one is
+        inside the other. Symbolic links in the destinations are resolved
+        before comparing them.
+        '''
+        groups = []
+        for backup_instance in backup_instances:
+            destination = os.path.realpath(backup_instance.destination)
+
+            # Merge the groups with an overlapping destination into the group
+            # of this instance, keeping the other groups as they are
+            destinations = [destination]
+            group = []
+            other_groups = []
+            for other_destinations, other_group in groups:
+                if any(path_is_parent(other_destination, destination) or
+                       path_is_parent(destination, other_destination)
+                       for other_destination in other_destinations):
+                    destinations.extend(other_destinations)
+                    group.extend(other_group)
+                else:
+                    other_groups.append((other_destinations, other_group))
+            group.append(backup_instance)
+            groups = other_groups + [(destinations, group)]
+
+        return [group for _, group in groups]
+
+    def _run_group(self, backup_instances, mount_points):
+        '''
+        Run the backups of a group of sections with overlapping destinations,
+        one after the other. A partition shared by the group is mounted when
+        the first section needs it and unmounted once all sections are done.
+        '''
+        try:
+            for backup_instance in backup_instances:
+                # Log which section we're running
+                self.logger.info(
+                    'Running section {:s}'.format(backup_instance.name))
+
+                # Run backups
+                if backup_instance.run(mount_points, unmount=False):
+                    # If backups were successful, add an entry in the cache
+                    # file
+                    with self._history_lock:
+                        self.history.setdefault(
+                            backup_instance.name,
+                            {})['last_backup'] = int(time.time())
+        finally:
+            # Only the section that mounted the partition unmounts it
+            for backup_instance in backup_instances:
+                backup_instance.unmount_partition_if_needed(mount_points)
+
+    def _check_pruned_backups(self):
+        '''
+        Raise a ValueError if a section removing old backups keeps its backups
+        in the same folder and with the same prefix as another section.
+        '''
+        sections_by_prefix = dict()
         for backup_instance in self.backup_instances:
-            # Log which section we're running
-            self.logger.info(
-                'Running section {:s}'.format(backup_instance.name))
-
-            # Run backups
-            if backup_instance.run():
-                # If backups were successful, add an entry in the cache file
-                self.history_reader.read_dict({
-                    backup_instance.name: {
-                        'last_backup': int(time.time())
-                    }
-                })
-        # Write updated history
-        with open(self.history_filename, 'w') as history_file:
-            self.history_reader.write(history_file)
+            sections_by_prefix.setdefault(backup_instance.backup_prefix,
+                                          []).append(backup_instance)
+
+        for backup_instances in sections_by_prefix.values():
+            if len(backup_instances) > 1 and any(
+                    backup_instance.prunes_backups()
+                    for backup_instance in backup_instances):
+                raise ValueError(
+                    "The sections {:s} keep their backups in the same folder "
+                    "with the same prefix, so old backups (option "
+                    "'retain_count') cannot be removed. Use a different "
+                    "'folder_prefix' for each section.".format(', '.join(
+                        "'{:s}'".format(backup_instance.name)
+                        for backup_instance in backup_instances)))
+
+    def _read_history(self):
+        '''
+        Read the history of previous backups as a dict mapping each section
+        name to a dict with the time of its last backup. If no history exists
+        yet, the INI history written by previous versions is migrated.
+        '''
+        try:
+            with open(self.history_filename) as history_file:
+                history = json.load(history_file)
+            # Valid JSON that is not an object cannot be used either
+            if not isinstance(history, dict):
+                raise ValueError('The history is not a JSON object.')
+            return self._check_history_entries(history)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            self.logger.warning('History file {:s} is corrupt. Ignoring '
+                                'it.'.format(self.history_filename))
+            return dict()
+
+        # Migrate the history from the old INI format, if it exists
+        legacy_reader = configparser.ConfigParser()
+        legacy_reader.read(
+            os.path.join(self.args.cache_directory,
+                         self.LEGACY_HISTORY_RELATIVE_PATH))
+        return {
+            section: {
+                'last_backup': legacy_reader.getint(
+                    section, 'last_backup', fallback=0)
+            }
+            for section in legacy_reader.sections()
+        }
+
+    def _check_history_entries(self, history):
+        '''
+        Remove the entries of the history read that are not a dict holding
+        the time of the last backup as a number, so that these sections are
+        backed up again, and return the history.
+        '''
+        for section, entry in list(history.items()):
+            last_backup = entry.get('last_backup', 0) \
+                if isinstance(entry, dict) else None
+            if isinstance(last_backup, bool) or \
+                    not isinstance(last_backup, (int, float)):
+                self.logger.warning('History of section {:s} in {:s} is '
+                                    'corrupt. Ignoring it.'.format(
+                                        section, self.history_filename))
+                del history[section]
+        return history
 
     def _make_system_directory_if_not_exists(self, filename):
         '''
@@ -590,11 +1392,9 @@ class BackupManager:
         errors are handled.
         '''
         try:
-            os.makedirs(os.path.dirname(filename))
-        except FileExistsError:
-            pass
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
         except PermissionError as e:
-            self.errlog("Permission denied. Exiting.")
+            self.logger.error("Permission denied. Exiting.")
             raise (e)
 
     @staticmethod
@@ -602,41 +1402,25 @@ class BackupManager:
         '''
         Parse config from a config file.
         '''
-        parser = configparser.ConfigParser()
-        parser.read_dict(BackupManager.get_default_config())
+        # Pass the cached defaults to the constructor. Interpolation is kept,
+        # since backup_folder defaults to %(mount_point)s.
+        parser = configparser.ConfigParser(
+            defaults=BackupManager._DEFAULT_CONFIG['DEFAULT'])
         parser.read(files_to_parse)
         return parser
 
-    @staticmethod
-    def get_default_config():
+    @classmethod
+    def get_default_config(cls):
         '''
         Return the default configuration as a dict, to be read using the
         ConfigParser's read_dict function.
         '''
-        config = dict()
-        config['DEFAULT'] = {
-            'mount_point': '',
-            'backup_folder': '%(mount_point)s',
-            'to_backup': '',
-            'backup_type': 'incremental',
-            'exclude_file': '',
-            'rsync_log_file': '',
-            'UUID': '',
-            'partition_label': '',
-            'partition_device': '',
-            'link_name': 'current',
-            'folder_prefix': 'backup-',
-            'frequency_seconds': '{:d}'.format(60 * 60 * 24),
-            'rebase_root': 'true',
-            'cross_filesystems': 'false',
-            'date_format': '%%Y-%%m-%%dT%%H:%%M',
-        }
-        return config
+        return cls._DEFAULT_CONFIG
 
 
-def parse_args(argv):
+def _make_parser():
     '''
-    Parse command line arguments.
+    Create the parser for the command line arguments.
     '''
     parser = argparse.ArgumentParser(description='Make local backups of disk.')
     parser.add_argument(
@@ -669,18 +1453,51 @@ def parse_args(argv):
         help="Path to directory where cache should be stored. A folder"
         " named 'ink' will be created in this directory to hold cache "
         "files. Default is '/var/cache'.")
-    return parser.parse_args(argv)
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        dest='jobs',
+        type=int,
+        default=1,
+        help="Maximum number of sections with separate destinations to back "
+        "up at the same time. Sections whose destinations are the same or "
+        "nested run one after the other. Default is 1.")
+    return parser
+
+
+# The parser does not change, so it is only built once
+_PARSER = _make_parser()
+
+
+def parse_args(argv):
+    '''
+    Parse command line arguments.
+    '''
+    return _PARSER.parse_args(argv)
 
 
 def main(argv):
     '''
     Main function to set up BackupManager using the options given in argv.
     '''
+    run(parse_args(argv))
+
+
+def run(args):
+    '''
+    Set up logging and BackupManager using the already parsed command line
+    arguments in args, and make the backups. Return a dict mapping the name of
+    each section backed up to the folder holding its new backups. If making
+    the backups failed, the sections backed up before the failure are still
+    returned.
+    '''
+    logger = logging.getLogger(__name__)
+    backup_manager = None
+    backup_folders = dict()
     try:
         # Setup logging format
-        logger = logging.getLogger(__name__)
         logger.setLevel(logging.DEBUG)
-        logformat = logging.Formatter(
+        logformat = CachedTimeFormatter(
             '[%(asctime)s] %(levelname)s: %(message)s')
 
         # Remove previous logging handlers
@@ -692,38 +1509,43 @@ def main(argv):
         logger.addHandler(ch)
 
         # Get log filename
-        args = parse_args(argv)
         log_filename = os.path.join(args.log_directory, LOG_RELATIVE_PATH)
 
         # Make log dir
         try:
-            os.makedirs(os.path.dirname(log_filename))
-        except FileExistsError:
-            pass
+            os.makedirs(os.path.dirname(log_filename), exist_ok=True)
         except PermissionError as e:
             print("Permission denied. Exiting.")
             sys.exit(1)
 
-        # Setup logging to file
+        # Setup logging to file, appending to the log of previous runs. The
+        # file is only opened when the first record is written.
         fh = logging.handlers.RotatingFileHandler(
-            log_filename, maxBytes=(1048576 * 5), backupCount=7)
+            log_filename, mode='a', maxBytes=(1048576 * 5), backupCount=7,
+            delay=True)
         fh.setFormatter(logformat)
         logger.addHandler(fh)
 
         # Make backups
         backup_manager = BackupManager(args)
-        backup_manager.run()
-
-        # Close loggers
-        fh.close()
-        ch.close()
-        logger.removeHandler(fh)
-        logger.removeHandler(ch)
+        backup_folders = backup_manager.run()
 
     except Exception as e:
         print('Making backups failed.')
         traceback.print_exc()
 
+        # Return the backups that were made anyway
+        if backup_manager is not None:
+            backup_folders = backup_manager.get_backup_folders()
+
+    finally:
+        # Close loggers, also when making the backups failed
+        for handler in list(logger.handlers):
+            handler.close()
+            logger.removeHandler(handler)
+
+    return backup_folders
+
 
 def main_from_command_line():
     '''
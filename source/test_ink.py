@@ -3,25 +3,105 @@
 import unittest
 import tempfile
 import os
-import stat
+import shutil
+import filecmp
 import ink
-import glob
 import time
-import copy
-import configparser
+import json
+import threading
+from unittest import mock
+
+# Template of a section of the configuration file, filled in with its name
+# and the options returned by _get_testing_config
+CONFIG_TEMPLATE = '''[{name}]
+mount_point = {mount_point}
+backup_folder = {backup_folder}
+to_backup = {to_backup}
+backup_type = {backup_type}
+exclude_file = {exclude_file}
+uuid = {UUID}
+partition_label = {partition_label}
+partition_device = {partition_device}
+link_name = {link_name}
+folder_prefix = {folder_prefix}
+frequency_seconds = {frequency_seconds}
+rebase_root = {rebase_root}
+date_format = {date_format}
+retain_count = {retain_count}
+parallel_shards = {parallel_shards}
+rsync_log_file = {rsync_log_file}
+rsync_fast_io = {rsync_fast_io}
+bwlimit = {bwlimit}
+whole_file = {whole_file}
+rsync_extra_args = {rsync_extra_args}
+ionice_class = {ionice_class}
+
+'''
+
 
 class RunBackupsUnitTest(unittest.TestCase):
     ''' Unit test for ink.py. '''
+    # Testing options that do not depend on the temporary directory, built
+    # once for all tests
+    TESTING_OPTIONS = {'mount_point': '',
+                       'backup_type': 'incremental',
+                       'exclude_file': '',
+                       'UUID': '',
+                       'partition_label': '',
+                       'partition_device': '',
+                       'link_name': 'current',
+                       'folder_prefix': 'backup-',
+                       'frequency_seconds': '0',
+                       'rebase_root': 'false',
+                       'retain_count': '0',
+                       'parallel_shards': '1',
+                       'rsync_log_file': '',
+                       'rsync_fast_io': 'false',
+                       'bwlimit': '',
+                       'whole_file': 'false',
+                       'rsync_extra_args': '',
+                       'ionice_class': '',
+                       }
+
+    # Date format of backups that are pruned, which must sort by date
+    PRUNED_DATE_FORMAT = '%%Y-%%m-%%dT%%H:%%M:%%S'
+
+    @classmethod
+    def setUpClass(cls):
+        '''
+        Create a temporary directory where the test backups and files should
+        be held. It is shared by all tests and emptied before each test.
+        '''
+        # Use a RAM-backed filesystem if there is one (Linux), since the
+        # tests check the backups and not the speed of the disk
+        if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+            tmp_root = '/dev/shm'
+        else:
+            tmp_root = None
+        cls.root_dir = tempfile.TemporaryDirectory(dir=tmp_root)
+
     def setUp(self):
         '''
         Set up the tests by:
-            - Creating a temporary directory where the test backups and files should be held.
+            - Emptying the temporary directory where the test backups and files should be held.
             - Creating a configuration file for the backups.
             - Initializing the files that will be backed up.
         '''
-        # Create a temporary directory where test backups and files will be
-        # held.
-        self.root_dir = tempfile.TemporaryDirectory()
+        # Control the clock used by ink, so that tests can move it forward
+        # instead of sleeping. Only the time module seen by ink is replaced.
+        self.clock_offset = 0
+        clock_patcher = mock.patch.object(ink, 'time', wraps=time)
+        clock_patcher.start().time.side_effect = \
+            lambda: time.time() + self.clock_offset
+        self.addCleanup(clock_patcher.stop)
+
+        # Empty the temporary directory left by the previous test
+        with os.scandir(self.root_dir.name) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
 
         # Create subdirectories to hold the original files and their backups.
         self.orig_dirname = os.path.join(self.root_dir.name, 'orig')
@@ -56,6 +136,7 @@ class RunBackupsUnitTest(unittest.TestCase):
         self.files = []
         self.files.append({'name': 'a', 'contents': 'This is file 1.'})
         self.files.append({'name': 'dir/b', 'contents': 'This is file 2.'})
+        self._known_files = dict()
         self._create_original_files(self.files)
 
         # Define command line arguments for running backups
@@ -63,96 +144,185 @@ class RunBackupsUnitTest(unittest.TestCase):
                      '--log-directory', self.log_directory,
                      '--cache-directory', self.cache_directory]
 
+        # Parse the command line arguments once for all runs of the test
+        self.args = ink.parse_args(self.argv)
+
     def _write_config_file(self, config):
-        ''' Write the configuration given in dict config to the config file.'''
-        parser = configparser.ConfigParser()
-        parser.read_dict(config)
+        ''' Write the configuration given in dict config, mapping the name of
+        each section to its options, to the config file.'''
         with open(self.config_filename, 'w') as configfile:
-            parser.write(configfile)
+            for name, options in config.items():
+                configfile.write(CONFIG_TEMPLATE.format(name=name, **options))
+
+    def _write_test_config(self, **overrides):
+        ''' Write the default testing configuration to the config file, with
+        the options given as keyword arguments changed.'''
+        config = self._get_testing_config()
+        config['testing'].update(overrides)
+        self._write_config_file(config)
+
+    def _write_sections_config(self, sections):
+        ''' Write a configuration file with one section per entry of the dict
+        sections, each holding the default testing configuration with the
+        options in the entry's dict changed.'''
+        options = self._get_testing_config()['testing']
+        self._write_config_file({
+            name: dict(options, **overrides)
+            for name, overrides in sections.items()})
 
     def _get_testing_config(self):
         '''
         Return the default testing configuration as a dict.
         '''
         config = dict()
-        config['testing'] = {'mount_point': '',
-                             'backup_folder': self.backups_container_dirname,
-                             'to_backup': self.orig_dirname,
-                             'backup_type': 'incremental',
-                             'exclude_file': '',
-                             'UUID': '',
-                             'partition_label': '',
-                             'partition_device': '',
-                             'link_name': 'current',
-                             'folder_prefix': 'backup-',
-                             'frequency_seconds': '0',
-                             'rebase_root': 'false',
-                             'date_format': self.date_format.replace('%', '%%'),
-                             };
+        config['testing'] = dict(self.TESTING_OPTIONS,
+                                 backup_folder=self.backups_container_dirname,
+                                 to_backup=self.orig_dirname,
+                                 date_format=self.date_format.replace('%', '%%'))
         return config
 
     def _create_original_files(self, files):
-        ''' Create the files given in directory self.orig_dirname.'''
+        ''' Create the files given in directory self.orig_dirname. Files whose
+        contents have not changed since they were last written are skipped.'''
         # Loop through files and create them
         for filecfg in files:
-            # Make directory if it doesn't exist
-            try:
-                os.makedirs(os.path.join(self.orig_dirname,
-                                         os.path.dirname(filecfg['name'])))
-            except FileExistsError:
-                pass
+            # Check if the contents of the file are equal to those last
+            # written, which are remembered instead of reading the file back
+            if self._known_files.get(filecfg['name']) == filecfg['contents']:
+                continue
 
-            # Check if the contents of the file are equal
-            try:
-                update_file = True
-                with open(os.path.join(self.orig_dirname, filecfg['name']),
-                          'r') as testfile:
-                    update_file = (testfile.read() != filecfg['contents'])
-            except FileNotFoundError:
-                pass
+            # Make directory if it doesn't exist
+            filename = os.path.join(self.orig_dirname, filecfg['name'])
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
 
             # Print new contents if they have changed
-            if update_file:
-                print('Updating file {:s} to read {:s}'.format(filecfg['name'],
-                                                               filecfg['contents']))
-                with open(os.path.join(self.orig_dirname, filecfg['name']), 'w') \
-                        as testfile:
-                    testfile.write(filecfg['contents'])
+            print('Updating file {:s} to read {:s}'.format(filecfg['name'],
+                                                           filecfg['contents']))
+            with open(filename, 'w') as testfile:
+                testfile.write(filecfg['contents'])
+            self._known_files[filecfg['name']] = filecfg['contents']
 
     def _compare_directory_content(self, files, dirname):
         ''' Run through the list of files and check that they exist in
         directory dirname and that their contents match.'''
+        # If the files are the ones currently in the original directory,
+        # compare the directories directly
+        if all(self._known_files.get(filecfg['name']) == filecfg['contents']
+               for filecfg in files):
+            names = [filecfg['name'] for filecfg in files]
+            match, mismatch, errors = filecmp.cmpfiles(
+                self.orig_dirname, dirname, names, shallow=False)
+            self.assertEqual(mismatch, [])
+            self.assertEqual(errors, [])
+            return
+
         # Check that all files in original directory exist in backup directory
         # and have identical contents
         for filecfg in files:
-            with open(os.path.join(dirname, filecfg['name']), 'r') \
+            with open(os.path.join(dirname, filecfg['name']), 'rb') \
                     as testfile:
-                self.assertEqual(testfile.read(), filecfg['contents'])
+                self.assertEqual(testfile.read(),
+                                 filecfg['contents'].encode('ascii'))
+
+    def _check_latest_backup_link(self, backup_dirname):
+        ''' Check that the link to the latest backups points to the backup
+        folder backup_dirname. The target of the link is read directly
+        rather than resolving the whole path.'''
+        link = os.path.join(self.backups_container_dirname, self.link_name)
+        self.assertEqual(
+            os.path.join(self.backups_container_dirname, os.readlink(link)),
+            backup_dirname)
+
+    def _sleep(self, seconds):
+        ''' Move the clock used by ink forward by the number of seconds given,
+        without actually waiting.'''
+        self.clock_offset += seconds
+
+    @staticmethod
+    def _scan_files(dirname, names):
+        ''' Return a dict mapping each of the relative file names given that
+        exists in directory dirname to its os.DirEntry. Each directory
+        containing the files is scanned only once.'''
+        # Group the names by the directory containing them
+        basenames_by_dir = dict()
+        for name in names:
+            parent, basename = os.path.split(name)
+            basenames_by_dir.setdefault(parent, dict())[basename] = name
+
+        # Scan each directory once and keep the entries for the names given
+        entries = dict()
+        for parent, basenames in basenames_by_dir.items():
+            try:
+                with os.scandir(os.path.join(dirname, parent)) as it:
+                    for entry in it:
+                        if entry.name in basenames:
+                            entries[basenames[entry.name]] = entry
+            except FileNotFoundError:
+                pass
+        return entries
+
+    def _mock_shell_commands(self, side_effect=None):
+        ''' Replace the shell commands run by ink with a mock for the rest of
+        the test, with no partitions listed as mounted, and return the mock.
+        If side_effect is given, it is called with the arguments of each
+        command.'''
+        patcher = mock.patch.object(ink, 'get_mount_points',
+                                    return_value=set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(ink, 'run_shell_command',
+                                    side_effect=side_effect)
+        run_shell_command = patcher.start()
+        self.addCleanup(patcher.stop)
+        return run_shell_command
+
+    @staticmethod
+    def _get_mount_commands(run_shell_command):
+        ''' Return the mount and umount commands run with the mock
+        run_shell_command, in the order they were run.'''
+        return [call.args[0] for call in run_shell_command.call_args_list
+                if call.args[0][0] in ('mount', 'umount')]
+
+    def _read_history(self):
+        ''' Return the history of the backups written by ink.'''
+        with open(os.path.join(self.cache_directory, 'ink',
+                               'history.json')) as history_file:
+            return json.load(history_file)
+
+    @staticmethod
+    def _get_tree(dirname):
+        ''' Return a dict mapping the relative path of each file and directory
+        in directory dirname, including dirname itself, to a tuple of its
+        permissions and its contents (None for directories).'''
+        tree = dict()
+        for root, dirnames, filenames in os.walk(dirname):
+            relative_root = os.path.relpath(root, dirname)
+            tree[relative_root] = (os.stat(root).st_mode, None)
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                with open(path, 'rb') as testfile:
+                    tree[os.path.join(relative_root, filename)] = (
+                        os.stat(path).st_mode, testfile.read())
+        return tree
 
     @staticmethod
     def _is_hard_link(filename1, filename2):
         ''' Returns true if the two filenames are hardlinks to the same
         file.'''
-        s1 = os.stat(filename1)
-        s2 = os.stat(filename2)
-        return (s1[stat.ST_INO], s1[stat.ST_DEV]) == \
-            (s2[stat.ST_INO], s2[stat.ST_DEV])
+        s1 = os.lstat(filename1)
+        s2 = os.lstat(filename2)
+        return (s1.st_ino, s1.st_dev) == (s2.st_ino, s2.st_dev)
 
     def test_make_incremental_backup(self):
         ''' Test that a simple backup can be made.'''
         print('')
         print('Running test make_incremental_backup.')
         # Set backup type to incremental
-        config = self._get_testing_config()
-        config['testing']['backup_type'] = 'incremental'
-        self._write_config_file(config)
+        self._write_test_config(backup_type='incremental')
 
         # Run backups with the relevant command line arguments
-        ink.main(self.argv)
-
-        # Get the directory containing the most recent backups
-        backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
+        backup_dirname = ink.run(self.args)['testing']
+        self._check_latest_backup_link(backup_dirname)
 
         # Check that all files in original directory exist in backup directory
         # and have identical contents
@@ -163,15 +333,14 @@ class RunBackupsUnitTest(unittest.TestCase):
         print('')
         print('Running test make_snapshot_backup.')
         # Set backup type to snapshot
-        config = self._get_testing_config()
-        config['testing']['backup_type'] = 'snapshot'
-        self._write_config_file(config)
+        self._write_test_config(backup_type='snapshot')
 
         # Run backups with the relevant command line arguments
-        ink.main(self.argv)
+        backup_dirname = ink.run(self.args)['testing']
 
-        # Get the directory containing the most recent backups
-        backup_dirname = self.backups_container_dirname
+        # Snapshot backups are made directly in the backup folder, without a
+        # link to the latest backups
+        self.assertEqual(backup_dirname, self.backups_container_dirname)
 
         # Check that all files in original directory exist in backup directory
         # and have identical contents
@@ -185,76 +354,65 @@ class RunBackupsUnitTest(unittest.TestCase):
         print('')
         print('Running test incremental_update_backup.')
         # Set backup type to incremental
-        config = self._get_testing_config()
-        config['testing']['backup_type'] = 'incremental'
-        self._write_config_file(config)
+        self._write_test_config(backup_type='incremental')
 
         # Make backups of original files
-        ink.main(self.argv)
-
-        # Get the directory containing the first backups
-        first_backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
+        first_backup_dirname = ink.run(self.args)['testing']
 
         # Update one file
-        updated_files = copy.deepcopy(self.files)
+        updated_files = [dict(filecfg) for filecfg in self.files]
         updated_files[0]['contents'] += ' Updated.'
         self._create_original_files(updated_files)
 
-        # Sleep for one second to make sure new backups will be run
-        time.sleep(1)
+        # Move the clock forward by one second to make sure new backups will
+        # be run
+        self._sleep(1)
 
         # Run backups again
-        ink.main(self.argv)
-
-        # Get the directory containing the most recent backups
-        backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
+        backup_dirname = ink.run(self.args)['testing']
+        self._check_latest_backup_link(backup_dirname)
 
         # Loop through newest backup folder and expect the content to be
         # updated.
         self._compare_directory_content(updated_files, backup_dirname)
 
         # For all files except the first (which was updated), expect the entry
-        # in both backups to be a hardlink to the same file
+        # in the new backup to be hardlinked, which needs one lstat per file
         self.assertFalse(self._is_hard_link(
                 os.path.join(first_backup_dirname, updated_files[0]['name']),
                 os.path.join(backup_dirname, updated_files[0]['name'])))
         for filecfg in updated_files[1:]:
-            self.assertTrue(self._is_hard_link(
-                os.path.join(first_backup_dirname, filecfg['name']),
-                os.path.join(backup_dirname, filecfg['name'])))
+            self.assertGreaterEqual(os.lstat(
+                os.path.join(backup_dirname, filecfg['name'])).st_nlink, 2)
+
+        # Spot-check that the link is shared with the first backup rather
+        # than some unrelated file
+        self.assertTrue(self._is_hard_link(
+                os.path.join(first_backup_dirname, updated_files[1]['name']),
+                os.path.join(backup_dirname, updated_files[1]['name'])))
 
     def test_nolinks_update_backup(self):
         ''' Test that an incremental backup updates itself. '''
         print('')
         print('Running test nolinks_update_backup.')
         # Set backup type to nolinks
-        config = self._get_testing_config()
-        config['testing']['backup_type'] = 'nolinks'
-        self._write_config_file(config)
+        self._write_test_config(backup_type='nolinks')
 
         # Make backups of original files
-        ink.main(self.argv)
-
-        # Get the directory containing the first backups
-        first_backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
+        first_backup_dirname = ink.run(self.args)['testing']
 
         # Update one file
-        updated_files = copy.deepcopy(self.files)
+        updated_files = [dict(filecfg) for filecfg in self.files]
         updated_files[0]['contents'] += ' Updated.'
         self._create_original_files(updated_files)
 
-        # Sleep for one second to make sure new backups will be run
-        time.sleep(1)
+        # Move the clock forward by one second to make sure new backups will
+        # be run
+        self._sleep(1)
 
         # Run backups again
-        ink.main(self.argv)
-
-        # Get the directory containing the most recent backups
-        backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
+        backup_dirname = ink.run(self.args)['testing']
+        self._check_latest_backup_link(backup_dirname)
 
         # The first directory now has a suffix of _bak
         first_backup_dirname += '_bak'
@@ -268,9 +426,11 @@ class RunBackupsUnitTest(unittest.TestCase):
                                         first_backup_dirname)
 
         # Expect all other files to not exist in first backup directory
+        entries = self._scan_files(first_backup_dirname,
+                                   [filecfg['name'] for filecfg in self.files])
         for filecfg in self.files[1:]:
-            self.assertFalse(os.path.isfile(os.path.join(first_backup_dirname,
-                                                         filecfg['name'])))
+            entry = entries.get(filecfg['name'])
+            self.assertFalse(entry is not None and entry.is_file())
 
     def test_full_update_backup(self):
         ''' Test that a full backup updates itself. '''
@@ -278,31 +438,23 @@ class RunBackupsUnitTest(unittest.TestCase):
         print('Running test full_update_backup.')
 
         # Set backup type to full
-        config = self._get_testing_config()
-        config['testing']['backup_type'] = 'full'
-        self._write_config_file(config)
+        self._write_test_config(backup_type='full')
 
         # Make backups of original files
-        ink.main(self.argv)
-
-        # Get the directory containing the first backups
-        first_backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
+        first_backup_dirname = ink.run(self.args)['testing']
 
         # Update one file
-        updated_files = copy.deepcopy(self.files)
+        updated_files = [dict(filecfg) for filecfg in self.files]
         updated_files[0]['contents'] += ' Updated.'
         self._create_original_files(updated_files)
 
-        # Sleep for one second to make sure new backups will be run
-        time.sleep(1)
+        # Move the clock forward by one second to make sure new backups will
+        # be run
+        self._sleep(1)
 
         # Run backups again
-        ink.main(self.argv)
-
-        # Get the directory containing the most recent backups
-        backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
+        backup_dirname = ink.run(self.args)['testing']
+        self._check_latest_backup_link(backup_dirname)
 
         # Loop through newest backup folder and expect the content to be
         # updated.
@@ -314,10 +466,13 @@ class RunBackupsUnitTest(unittest.TestCase):
                                         first_backup_dirname)
 
         # Expect none of the files to be hardlinks
+        names = [filecfg['name'] for filecfg in updated_files]
+        first_entries = self._scan_files(first_backup_dirname, names)
+        entries = self._scan_files(backup_dirname, names)
         for filecfg in updated_files[1:]:
-            self.assertFalse(self._is_hard_link(
-                os.path.join(first_backup_dirname, filecfg['name']),
-                os.path.join(backup_dirname, filecfg['name'])))
+            s1 = first_entries[filecfg['name']].stat(follow_symlinks=False)
+            s2 = entries[filecfg['name']].stat(follow_symlinks=False)
+            self.assertNotEqual((s1.st_ino, s1.st_dev), (s2.st_ino, s2.st_dev))
 
     def test_snapshot_update_backup(self):
         ''' Test that a snapshot backup updates itself. '''
@@ -325,12 +480,10 @@ class RunBackupsUnitTest(unittest.TestCase):
         print('Running test snapshot_update_backup.')
 
         # Set backup type to snapshot
-        config = self._get_testing_config()
-        config['testing']['backup_type'] = 'snapshot'
-        self._write_config_file(config)
+        self._write_test_config(backup_type='snapshot')
 
         # Make backups of original files
-        ink.main(self.argv)
+        ink.run(self.args)
 
         # Get the directory containing the most recent backups
         backup_dirname = self.backups_container_dirname
@@ -341,28 +494,33 @@ class RunBackupsUnitTest(unittest.TestCase):
             modification_times.append(os.path.getmtime(os.path.join(backup_dirname,
                                                          filecfg['name'])))
 
-        # Update one file
-        updated_files = copy.deepcopy(self.files)
+        # Update one file, and give it a later modification time explicitly,
+        # since the clock of the filesystem may not have advanced
+        updated_files = [dict(filecfg) for filecfg in self.files]
         updated_files[0]['contents'] += ' Updated.'
         self._create_original_files(updated_files)
+        updated_time = int(modification_times[0]) + 10
+        os.utime(os.path.join(self.orig_dirname, updated_files[0]['name']),
+                 (updated_time, updated_time))
 
-        # Sleep for one second to make sure new backups will be run
-        time.sleep(1)
+        # Move the clock forward by one second to make sure new backups will
+        # be run
+        self._sleep(1)
 
         # Run backups again
-        ink.main(self.argv)
+        ink.run(self.args)
 
         # Loop through newest backup folder and expect the content to be
         # updated.
         self._compare_directory_content(updated_files, backup_dirname)
 
-        # Expect the first file to have a new, later modification time but the
-        # others to be the same
+        # Expect the first file to have the modification time set above but
+        # the others to be the same
         for index, filecfg in enumerate(updated_files):
             if index == 0:
-                self.assertGreater(os.path.getmtime(os.path.join(backup_dirname,
+                self.assertEqual(os.path.getmtime(os.path.join(backup_dirname,
                                                          filecfg['name'])),
-                           modification_times[index])
+                           updated_time)
             else:
                 self.assertEqual(os.path.getmtime(os.path.join(backup_dirname,
                                                          filecfg['name'])),
@@ -373,20 +531,12 @@ class RunBackupsUnitTest(unittest.TestCase):
         print('')
         print('Running test rebase_root.')
         # Set backup type to incremental
-        config = self._get_testing_config()
-        config['testing']['backup_type'] = 'incremental'
-
-        # Set rebase_root option
-        config['testing']['rebase_root'] = 'true'
-        self._write_config_file(config)
+        # and set rebase_root option
+        self._write_test_config(backup_type='incremental', rebase_root='true')
 
         # Run backups with the relevant command line arguments
-        ink.main(self.argv)
-
-        # Get the directory containing the most recent backups
-        backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name,
-                         self.orig_dirname[1:]))
+        backup_dirname = os.path.join(ink.run(self.args)['testing'],
+                                      self.orig_dirname[1:])
 
         # Check that all files in original directory exist in backup directory
         # and have identical contents
@@ -397,45 +547,107 @@ class RunBackupsUnitTest(unittest.TestCase):
         print('')
         print('Running test frequency.')
         # Set backup type to incremental
-        config = self._get_testing_config()
-        config['testing']['backup_type'] = 'incremental'
-
-        # Set backup frequency
+        # and set backup frequency
         frequency = 5
-        config['testing']['frequency_seconds'] = '5' #'{:d}'.format(frequency)
-        self._write_config_file(config)
+        self._write_test_config(backup_type='incremental',
+                                frequency_seconds='{:d}'.format(frequency))
 
         # Run backups with the relevant command line arguments
-        first_backup_time = time.time()
-        ink.main(self.argv)
-
-        # Get the directory containing the most recent backups
-        first_backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
+        first_backup_dirname = ink.run(self.args)['testing']
 
-        # Check that the time elapsed is less than the frequency and try making
+        # Move the clock forward by less than the frequency and try making
         # backups again
-        self.assertLess(time.time(), first_backup_time + frequency, msg =
-                        'Frequency is too short. Increase the frequency and '
-                        'run the test again.')
-        ink.main(self.argv)
+        self._sleep(1)
+        backup_folders = ink.run(self.args)
 
         # No new backup should be created
-        backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
-        self.assertEqual(backup_dirname, first_backup_dirname)
+        self.assertEqual(backup_folders, {})
 
-        # Wait until time elapsed is greater than frequency and try making
-        # backups again
-        time.sleep(frequency)
-        self.assertGreater(time.time(), first_backup_time + frequency)
-        ink.main(self.argv)
+        # Move the clock past the frequency and try making backups again
+        self._sleep(frequency)
+        backup_folders = ink.run(self.args)
 
         # New backups should be created
-        backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
+        backup_dirname = backup_folders['testing']
         self.assertNotEqual(backup_dirname, first_backup_dirname)
 
+    def test_nothing_due(self):
+        ''' Test that a run with no section due neither reads the mounted
+        partitions nor rewrites the history.'''
+        print('')
+        print('Running test nothing_due.')
+        self._write_test_config(frequency_seconds='60')
+        ink.run(self.args)
+        history_filename = os.path.join(self.cache_directory, 'ink',
+                                        'history.json')
+        history_stat = os.stat(history_filename)
+
+        # Run again before the next backup is due
+        self._sleep(1)
+        with mock.patch.object(ink, 'get_mount_points') as get_mount_points:
+            self.assertEqual(ink.run(self.args), {})
+        get_mount_points.assert_not_called()
+
+        # The history is replaced by a new file when it is written
+        new_history_stat = os.stat(history_filename)
+        self.assertEqual(
+            (new_history_stat.st_ino, new_history_stat.st_mtime_ns),
+            (history_stat.st_ino, history_stat.st_mtime_ns))
+
+    def test_history(self):
+        ''' Test that backups are only made if the history read is outdated,
+        and that a history that is not a JSON object is ignored.'''
+        print('')
+        print('Running test history.')
+        self._write_test_config(frequency_seconds='60')
+        history_filename = os.path.join(self.cache_directory, 'ink',
+                                        'history.json')
+        os.makedirs(os.path.dirname(history_filename))
+
+        # A recent backup in the history means no backups are due
+        with open(history_filename, 'w') as history_file:
+            json.dump({'testing': {'last_backup': int(time.time())}},
+                      history_file)
+        self.assertEqual(ink.run(self.args), {})
+
+        # Any other JSON is ignored, so the backups are made
+        for history in ('[]', 'null'):
+            with open(history_filename, 'w') as history_file:
+                history_file.write(history)
+            self.assertIn('testing', ink.run(self.args))
+
+        # The same holds for entries of sections that cannot be used
+        for entry in (5, None, {'last_backup': '12'},
+                      {'last_backup': None}):
+            with open(history_filename, 'w') as history_file:
+                json.dump({'testing': entry}, history_file)
+            self.assertIn('testing', ink.run(self.args))
+            self.assertIsInstance(
+                self._read_history()['testing']['last_backup'], int)
+
+    def test_legacy_history(self):
+        ''' Test that the INI history of previous versions is migrated.'''
+        print('')
+        print('Running test legacy_history.')
+        self._write_test_config(frequency_seconds='60')
+        last_backup = int(time.time())
+        os.makedirs(os.path.join(self.cache_directory, 'ink'))
+        with open(os.path.join(self.cache_directory, 'ink', 'history'),
+                  'w') as history_file:
+            history_file.write('[testing]\nlast_backup = {:d}\n'.format(
+                last_backup))
+
+        # The legacy history is read and no backups are due
+        self.assertEqual(ink.BackupManager(self.args).history,
+                         {'testing': {'last_backup': last_backup}})
+        self.assertEqual(ink.run(self.args), {})
+
+        # Once backups are made, the history is written as JSON
+        self._sleep(61)
+        self.assertIn('testing', ink.run(self.args))
+        self.assertGreater(self._read_history()['testing']['last_backup'],
+                           last_backup)
+
     def test_default_exclude(self):
         '''
         Test that the folder containing the backups is excluded when it is a
@@ -444,19 +656,12 @@ class RunBackupsUnitTest(unittest.TestCase):
         print('')
         print('Running test default_exclude.')
         # Set backup type to incremental
-        config = self._get_testing_config()
-        config['testing']['backup_type'] = 'incremental'
-
-        # Backup the root directory
-        config['testing']['to_backup'] = self.root_dir.name
-        self._write_config_file(config)
+        # and backup the root directory
+        self._write_test_config(backup_type='incremental',
+                                to_backup=self.root_dir.name)
 
         # Run backups with the relevant command line arguments
-        ink.main(self.argv)
-
-        # Get the directory containing the most recent backups
-        backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
+        backup_dirname = ink.run(self.args)['testing']
 
         # Check that the folder containing the backups does not exist in the
         # backup
@@ -483,31 +688,368 @@ class RunBackupsUnitTest(unittest.TestCase):
         print('')
         print('Running test nolinks_linkname.')
         # Set backup type to incremental
-        config = self._get_testing_config()
-        config['testing']['backup_type'] = 'incremental'
-        self._write_config_file(config)
+        self._write_test_config(backup_type='incremental')
 
         # Run backups with the relevant command line arguments
-        ink.main(self.argv)
-
-        # Get the directory containing the most recent backups
-        first_backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
+        first_backup_dirname = ink.run(self.args)['testing']
 
         # Set backup type to nolinks
-        config['testing']['backup_type'] = 'nolinks'
-        self._write_config_file(config)
+        self._write_test_config(backup_type='nolinks')
 
-        # Sleep for 1 second to make sure backups run again
-        time.sleep(1)
+        # Move the clock forward by 1 second to make sure backups run again
+        self._sleep(1)
 
         # Run backups again
-        ink.main(self.argv)
+        backup_dirname = ink.run(self.args)['testing']
+        self._check_latest_backup_link(backup_dirname)
 
-        # Get the directory containing the most recent backups
-        backup_dirname = os.path.realpath(
-            os.path.join(self.backups_container_dirname, self.link_name))
+    def test_retain_count(self):
+        ''' Test that only the newest backups are kept, and that folders not
+        made by ink are never removed.'''
+        print('')
+        print('Running test retain_count.')
+        # Keep two backups, named with the full date so that they sort by it
+        self._write_sections_config({'testing': {
+            'retain_count': '2',
+            'date_format': self.PRUNED_DATE_FORMAT}})
+
+        # Add folders that are not backups next to them
+        other_dirnames = [
+            os.path.join(self.backups_container_dirname, name)
+            for name in ('lost+found', 'backup-notes')]
+        for dirname in other_dirnames:
+            os.mkdir(dirname)
+
+        # Make three backups. The oldest is changed after the second, so it
+        # has the latest change time when the third is made.
+        backup_dirnames = [ink.run(self.args)['testing']]
+        self._sleep(1)
+        backup_dirnames.append(ink.run(self.args)['testing'])
+        os.chmod(backup_dirnames[0], 0o700)
+        self._sleep(1)
+        backup_dirnames.append(ink.run(self.args)['testing'])
+
+        # Expect the oldest backup to be removed and everything else kept
+        self.assertFalse(os.path.exists(backup_dirnames[0]))
+        for dirname in backup_dirnames[1:] + other_dirnames:
+            self.assertTrue(os.path.isdir(dirname))
+
+    def test_retain_count_same_date(self):
+        ''' Test that the newest backups are kept if several are made with the
+        same date in their names.'''
+        print('')
+        print('Running test retain_count_same_date.')
+        self._write_sections_config({'testing': {
+            'retain_count': '2', 'date_format': '%%Y-%%m-%%d'}})
+
+        # Make five backups on the same day and expect the last two to be kept
+        backup_dirnames = [ink.run(self.args)['testing'] for _ in range(5)]
+        for dirname in backup_dirnames[:3]:
+            self.assertFalse(os.path.exists(dirname))
+        for dirname in backup_dirnames[3:]:
+            self.assertTrue(os.path.isdir(dirname))
+
+    def test_retain_count_date_format(self):
+        ''' Test that backups are only pruned with a date format that sorts
+        by date.'''
+        print('')
+        print('Running test retain_count_date_format.')
+        for date_format in ('%%T', '%%m-%%d', '%%Y-%%d', '%%Y %%H:%%M',
+                            '%%a'):
+            self._write_sections_config({'testing': {
+                'retain_count': '1', 'date_format': date_format}})
+            self.assertRaises(ValueError, ink.BackupManager, self.args)
+
+        # Coarse formats and the day of the year are fine
+        for date_format in ('%%Y', '%%Y-%%m', '%%F', '%%Y-%%jT%%H:%%M'):
+            self._write_sections_config({'testing': {
+                'retain_count': '1', 'date_format': date_format}})
+            ink.BackupManager(self.args)
+
+    def test_retain_count_without_prefix(self):
+        ''' Test that backups without a folder prefix are not pruned.'''
+        print('')
+        print('Running test retain_count_without_prefix.')
+        self._write_sections_config({'testing': {
+            'retain_count': '1', 'folder_prefix': '',
+            'date_format': self.PRUNED_DATE_FORMAT}})
+        other_dirname = os.path.join(self.backups_container_dirname,
+                                     'lost+found')
+        os.mkdir(other_dirname)
+
+        # Make two backups and expect both to be kept
+        first_backup_dirname = ink.run(self.args)['testing']
+        self._sleep(1)
+        backup_dirname = ink.run(self.args)['testing']
+        for dirname in (first_backup_dirname, backup_dirname, other_dirname):
+            self.assertTrue(os.path.isdir(dirname))
+
+    def test_retain_count_shared_folder(self):
+        ''' Test that sections sharing their backup folder only remove their
+        own backups.'''
+        print('')
+        print('Running test retain_count_shared_folder.')
+        # Sections with the same folder and prefix are rejected
+        self._write_sections_config({
+            'one': {'retain_count': '1', 'link_name': 'current-one',
+                    'date_format': self.PRUNED_DATE_FORMAT},
+            'two': {'link_name': 'current-two'}})
+        self.assertRaises(ValueError, ink.BackupManager, self.args)
+
+        # Sections with different prefixes are pruned separately, also if
+        # one prefix starts with the other
+        self._write_sections_config({
+            'one': {'retain_count': '1', 'link_name': 'current-one',
+                    'folder_prefix': 'one-',
+                    'date_format': self.PRUNED_DATE_FORMAT},
+            'two': {'retain_count': '1', 'link_name': 'current-two',
+                    'folder_prefix': 'one-two-',
+                    'date_format': self.PRUNED_DATE_FORMAT}})
+        first_backup_dirnames = ink.run(self.args)
+        self._sleep(1)
+        backup_dirnames = ink.run(self.args)
+        for name in ('one', 'two'):
+            self.assertFalse(os.path.exists(first_backup_dirnames[name]))
+            self.assertTrue(os.path.isdir(backup_dirnames[name]))
+
+    def test_overlapping_destinations(self):
+        ''' Test that sections whose destinations are the same or nested run
+        one after the other, also when -j allows running them at the same
+        time.'''
+        print('')
+        print('Running test overlapping_destinations.')
+        # Destinations are compared with symbolic links resolved
+        container = self.backups_container_dirname
+        os.symlink('x', os.path.join(container, 'link'))
+        self._write_sections_config({
+            'same': {'backup_folder': os.path.join(container, 'x')},
+            'nested': {'backup_folder': os.path.join(container, 'x', 'sub')},
+            'symlink': {'backup_folder': os.path.join(container, 'link')},
+            'separate': {'backup_folder': os.path.join(container, 'y')},
+            'partition': {'mount_point': os.path.join(container, 'm'),
+                          'backup_folder': 'backups'},
+            'on_partition': {
+                'backup_folder': os.path.join(container, 'm', 'other')}})
+        self.args.jobs = 4
+
+        # Record the sections of each group instead of running them
+        with mock.patch.object(ink.BackupManager, '_run_group') as run_group:
+            ink.BackupManager(self.args).run()
+        groups = sorted(
+            sorted(backup_instance.name for backup_instance in call.args[0])
+            for call in run_group.call_args_list)
+        self.assertEqual(groups, [['nested', 'same', 'symlink'],
+                                  ['on_partition', 'partition'],
+                                  ['separate']])
+
+    def test_mount_once_per_group(self):
+        ''' Test that a partition shared by several sections is mounted and
+        unmounted only once.'''
+        print('')
+        print('Running test mount_once_per_group.')
+        mount_points = [os.path.join(self.backups_container_dirname, name)
+                        for name in ('m', 'n')]
+        self._write_sections_config({
+            'one': {'mount_point': mount_points[0], 'backup_folder': 'one'},
+            'two': {'mount_point': mount_points[0], 'backup_folder': 'two'},
+            'three': {'mount_point': mount_points[1],
+                      'backup_folder': 'three'}})
+        self.args.jobs = 2
+        run_shell_command = self._mock_shell_commands()
+
+        ink.BackupManager(self.args).run()
+
+        # Expect each partition to be mounted before it is unmounted
+        mount_commands = self._get_mount_commands(run_shell_command)
+        for mount_point in mount_points:
+            self.assertEqual(
+                [command for command in mount_commands
+                 if command[-1] == mount_point],
+                [['mount', mount_point], ['umount', mount_point]])
+        self.assertEqual(set(self._read_history()), {'one', 'two', 'three'})
+
+    def test_groups_run_in_parallel(self):
+        ''' Test that sections with separate destinations run at the same time
+        if -j allows it.'''
+        print('')
+        print('Running test groups_run_in_parallel.')
+        self._write_sections_config({
+            name: {'backup_folder': os.path.join(
+                self.backups_container_dirname, name)}
+            for name in ('one', 'two')})
+        self.args.jobs = 2
+
+        # Each rsync waits for the other one to start, which only succeeds if
+        # both run at the same time
+        barrier = threading.Barrier(2, timeout=10)
+        self._mock_shell_commands(
+            side_effect=lambda command, *args, **kwargs: barrier.wait())
+
+        self.assertEqual(set(ink.BackupManager(self.args).run()),
+                         {'one', 'two'})
+        self.assertEqual(set(self._read_history()), {'one', 'two'})
+
+    def test_group_failure(self):
+        ''' Test that a group failing to mount its partition neither stops
+        the other groups nor the history from being written.'''
+        print('')
+        print('Running test group_failure.')
+        mount_points = [os.path.join(self.backups_container_dirname, name)
+                        for name in ('m', 'n')]
+        self._write_sections_config({
+            'one': {'mount_point': mount_points[0], 'backup_folder': 'one'},
+            'two': {'mount_point': mount_points[0], 'backup_folder': 'two'},
+            'three': {'mount_point': mount_points[1],
+                      'backup_folder': 'three'}})
+        self.args.jobs = 2
+
+        def run_shell_command(command, *args, **kwargs):
+            if command == ['mount', mount_points[1]]:
+                raise RuntimeError('Mounting backup disk failed.')
+        mock_run_shell_command = self._mock_shell_commands(
+            side_effect=run_shell_command)
+
+        self.assertRaises(RuntimeError, ink.BackupManager(self.args).run)
+
+        # Expect the other group to be backed up and its partition unmounted
+        self.assertEqual(set(self._read_history()), {'one', 'two'})
+        self.assertIn(['umount', mount_points[0]],
+                      self._get_mount_commands(mock_run_shell_command))
+
+    def test_default_rsync_command(self):
+        ''' Test the rsync command run with the default options.'''
+        print('')
+        print('Running test default_rsync_command.')
+        self._write_test_config()
+        run_shell_command = self._mock_shell_commands()
+
+        backup_dirname = ink.run(self.args)['testing']
 
-    def tearDown(self):
+        run_shell_command.assert_called_once_with(
+            ['rsync', '-au', '-x', self.orig_dirname + '/',
+             backup_dirname + '/'], logger=mock.ANY)
+
+    def test_rsync_options(self):
+        ''' Test that the rsync tuning options are added to the rsync
+        command.'''
+        print('')
+        print('Running test rsync_options.')
+        self._write_sections_config({'testing': {
+            'rsync_fast_io': 'true',
+            'bwlimit': '10M',
+            'whole_file': 'true',
+            'rsync_extra_args': "--fsync --exclude 'a b'",
+            'ionice_class': '3'}})
+        run_shell_command = self._mock_shell_commands()
+
+        # Make two backups, so that the second links to the first
+        first_backup_dirname = ink.run(self.args)['testing']
+        self._sleep(1)
+        backup_dirname = ink.run(self.args)['testing']
+
+        # Expect rsync to run through ionice, and the extra arguments to be
+        # split like a shell command line
+        base_command = ['ionice', '-c', '3', 'rsync', '-au', '-x',
+                        '--bwlimit=10M', '-W', '--fsync', '--exclude', 'a b']
+        link_dest = os.path.join(self.backups_container_dirname,
+                                 self.link_name)
+        self.assertEqual(
+            [call.args[0] for call in run_shell_command.call_args_list],
+            [base_command + [self.orig_dirname + '/',
+                             first_backup_dirname + '/'],
+             base_command + ['--link-dest=' + link_dest, '--inplace',
+                             '--preallocate', '--block-size=131072',
+                             self.orig_dirname + '/', backup_dirname + '/']])
+
+    def test_command_output_logging(self):
+        ''' Test that the output of a command is logged as info, and its
+        errors as warnings.'''
+        print('')
+        print('Running test command_output_logging.')
+        logger = mock.Mock()
+        ink.run_shell_command(['sh', '-c', 'echo output; echo error >&2'],
+                              logger=logger)
+        logger.info.assert_called_once_with('output')
+        logger.warning.assert_called_once_with('error')
+
+    def test_exclude_file_on_partition(self):
+        ''' Test that an exclude file on the backup partition is used once the
+        partition is mounted.'''
+        print('')
+        print('Running test exclude_file_on_partition.')
+        mount_point = os.path.join(self.backups_container_dirname, 'm')
+        exclude_filename = os.path.join(mount_point, 'exclude')
+        self._write_test_config(mount_point=mount_point,
+                                backup_folder='backups',
+                                exclude_file=exclude_filename)
+
+        # The exclude file only appears once the partition is mounted
+        def run_shell_command(command, *args, **kwargs):
+            if command[0] == 'mount':
+                os.makedirs(mount_point)
+                with open(exclude_filename, 'w') as exclude_file:
+                    exclude_file.write('dir\n')
+        mock_run_shell_command = self._mock_shell_commands(
+            side_effect=run_shell_command)
+
+        ink.BackupManager(self.args).run()
+
+        rsync_command = mock_run_shell_command.call_args_list[1].args[0]
+        self.assertEqual(rsync_command[0], 'rsync')
+        self.assertIn('--exclude-from=' + exclude_filename, rsync_command)
+
+    def test_parallel_shards(self):
+        ''' Test that a backup copied by several rsync processes is the same
+        as one copied by a single rsync.'''
+        print('')
+        print('Running test parallel_shards.')
+        # Add more top-level directories and files, and change the
+        # permissions of the directory backed up
+        self._create_original_files(self.files + [
+            {'name': 'c', 'contents': 'This is file 3.'},
+            {'name': 'dir2/d', 'contents': 'This is file 4.'},
+            {'name': 'dir3/sub/e', 'contents': 'This is file 5.'},
+            {'name': 'dir4/f', 'contents': 'This is file 6.'}])
+        os.chmod(self.orig_dirname, 0o750)
+
+        # Back up the same directory with and without shards
+        rsync_log_filename = os.path.join(self.root_dir.name, 'rsync.log')
+        self._write_sections_config({
+            'single': {'folder_prefix': 'single-',
+                       'link_name': 'current-single'},
+            'sharded': {'folder_prefix': 'sharded-',
+                        'link_name': 'current-sharded',
+                        'parallel_shards': '3',
+                        'rsync_log_file': rsync_log_filename}})
+        backup_dirnames = ink.run(self.args)
+
+        self.assertEqual(self._get_tree(backup_dirnames['sharded']),
+                         self._get_tree(backup_dirnames['single']))
+
+        # Expect each shard to write its own log file
+        for i in range(3):
+            self.assertTrue(os.path.exists(
+                '{:s}.shard{:d}'.format(rsync_log_filename, i)))
+
+    def test_partial_results(self):
+        ''' Test that the backups made are returned even if another section
+        failed.'''
+        print('')
+        print('Running test partial_results.')
+        mount_point = os.path.join(self.backups_container_dirname, 'n')
+        self._write_sections_config({
+            'one': {'backup_folder': os.path.join(
+                self.backups_container_dirname, 'one')},
+            'two': {'mount_point': mount_point, 'backup_folder': 'two'}})
+
+        def run_shell_command(command, *args, **kwargs):
+            if command[0] == 'mount':
+                raise RuntimeError('Mounting backup disk failed.')
+        self._mock_shell_commands(side_effect=run_shell_command)
+
+        self.assertEqual(list(ink.run(self.args)), ['one'])
+
+    @classmethod
+    def tearDownClass(cls):
         # Clean up temporary directory
-        self.root_dir.cleanup()
+        cls.root_dir.cleanup()